@@ -130,3 +130,119 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Routing
+# Largest fraction of an alternative's riding distance that may be spent on
+# routes already used by the alternatives returned before it.
+
+ROUTING_MAX_SHARED_FRACTION = 0.5
+
+# Search used for single-path queries: 'dijkstra', 'astar' (straight-line
+# distance to the nearest end point as heuristic) or 'bidirectional'.
+
+ROUTING_SEARCH_MODE = 'dijkstra'
+
+# Stops at most this many metres apart are connected by walking transfers,
+# costed as a transfer plus the walk times the walking multiplier. Set to 0
+# to only allow transfers at the same stop.
+
+ROUTING_MAX_TRANSFER_WALK = 150.0
+
+# Candidate paths examined per requested alternative before BestRoutesView
+# settles for fewer alternatives.
+
+ROUTING_CANDIDATES_PER_PATH = 50
+
+# Seconds between checks of the network data version. Derived structures
+# (spatial indexes, the routing graph) built from an older version are
+# rebuilt in the background and swapped in when ready.
+
+ROUTING_VERSION_POLL_INTERVAL = 1.0
+
+# BestRoutesView caches its search results, keyed on the snapped origin and
+# destination stops and their walking distances rounded to
+# ROUTING_PATH_CACHE_COST_STEP metres. Entries live for
+# ROUTING_PATH_CACHE_TTL seconds and are dropped when the network data
+# changes. Set ROUTING_PATH_CACHE_SIZE to 0 to disable the cache.
+
+ROUTING_PATH_CACHE_SIZE = 1024
+ROUTING_PATH_CACHE_TTL = 300.0
+ROUTING_PATH_CACHE_COST_STEP = 5.0
+
+# Threads used to run route searches for the batch endpoint.
+
+ROUTING_SEARCH_WORKERS = 4
+
+# Most origin/destination pairs accepted by one batch routing request.
+
+ROUTING_BATCH_MAX_PAIRS = 1000
+
+# Searches one batch request keeps on the ROUTING_SEARCH_WORKERS threads at
+# once, started in the order their results are streamed.
+
+ROUTING_BATCH_MAX_IN_FLIGHT = 2
+
+# Largest origins x destinations matrix served by the distance matrix
+# endpoint. Larger matrices are written to disk by the distancematrix
+# management command.
+
+ROUTING_MATRIX_MAX_CELLS = 250000
+
+# Best-route, nearby-route, line-route, reachable-stop and distance matrix
+# requests run on a pool of this many threads, and each batch request holds
+# one of its slots while it streams. When all of them are busy, further
+# requests get a 503 with a Retry-After of ROUTING_BUSY_RETRY_AFTER seconds
+# instead of queueing.
+
+ROUTING_MAX_CONCURRENT_SEARCHES = 8
+ROUTING_BUSY_RETRY_AFTER = 1
+
+# Time the routing stages (snapping, graph load, each search, rendering).
+# Best-route responses then carry a Server-Timing header, and /metrics
+# serves the aggregated histograms in Prometheus text format. When off, the
+# timers are no-ops.
+
+ROUTING_METRICS_ENABLED = False
+
+# Directory of network snapshots written by the buildsnapshot command.
+# Processes load derived structures for the current network version from a
+# matching snapshot, memory-mapping its arrays so that every worker shares
+# the same pages, and build from the database otherwise. None disables
+# snapshots.
+
+ROUTING_SNAPSHOT_DIR = None
+
+# Route uploads reuse an existing point within this many metres of an
+# uploaded coordinate instead of creating a new one, and accept at most
+# ROUTING_UPLOAD_MAX_STOPS coordinates.
+
+ROUTING_UPLOAD_SNAP_TOLERANCE = 10.0
+ROUTING_UPLOAD_MAX_STOPS = 5000
+
+# Page size of the lines, points, steps and routes listings, and the largest
+# one a client may ask for with ?page_size=.
+
+ROUTING_PAGE_SIZE = 100
+ROUTING_MAX_PAGE_SIZE = 1000
+
+# The lines, points, steps, routes and line-routes endpoints answer with an
+# ETag derived from the network data version and tell clients to reuse a
+# response for ROUTING_NETWORK_MAX_AGE seconds before revalidating. Up to
+# ROUTING_RESPONSE_CACHE_SIZE rendered JSON bodies are kept for
+# ROUTING_RESPONSE_CACHE_TTL seconds, and dropped when the network changes.
+
+ROUTING_NETWORK_MAX_AGE = 300
+ROUTING_RESPONSE_CACHE_SIZE = 256
+ROUTING_RESPONSE_CACHE_TTL = 3600.0
+
+# Zoom levels served by the map tile endpoint; stops are only included from
+# ROUTING_TILE_STOPS_MIN_ZOOM on. Tiles are rendered on first request and
+# up to ROUTING_TILE_CACHE_SIZE of them are kept for ROUTING_TILE_CACHE_TTL
+# seconds, until the network changes.
+
+ROUTING_TILE_MIN_ZOOM = 8
+ROUTING_TILE_MAX_ZOOM = 18
+ROUTING_TILE_STOPS_MIN_ZOOM = 14
+ROUTING_TILE_CACHE_SIZE = 4096
+ROUTING_TILE_CACHE_TTL = 3600.0
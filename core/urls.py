@@ -16,8 +16,10 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from routecalc.views import MetricsView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('routecalc.urls')),
+    path('metrics', MetricsView, name='metrics'),
 ]
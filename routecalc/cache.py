@@ -0,0 +1,75 @@
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from .versioning import network_version
+
+
+class VersionedLRUCache:
+    """Thread-safe LRU cache whose entries expire after a TTL and are all
+    dropped when the network data version changes.
+
+    ``size_setting`` and ``ttl_setting`` name the settings holding the
+    maximum number of entries and their lifetime in seconds; they are read
+    on every call so they can be changed at runtime. A size of 0 disables
+    the cache. ``put`` can be given the network version a value was computed
+    from, e.g. that of a derived structure still being rebuilt; values older
+    than the current version are not stored.
+    """
+
+    def __init__(self, size_setting, ttl_setting):
+        self.size_setting = size_setting
+        self.ttl_setting = ttl_setting
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _check_version(self):
+        version = network_version()
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value, version=None):
+        size = getattr(settings, self.size_setting)
+        if size <= 0:
+            return
+        expires = time.monotonic() + getattr(settings, self.ttl_setting)
+        with self._lock:
+            self._check_version()
+            if version is not None and version != self._version:
+                return
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
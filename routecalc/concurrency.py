@@ -0,0 +1,133 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.views import APIView
+
+
+class SearchLimiter:
+    """Bounded pool for heavy views, with one thread per allowed request.
+
+    ``ROUTING_MAX_CONCURRENT_SEARCHES`` requests run at once; ``enter()``
+    returns False instead of waiting when they are all taken.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+
+    def _setup(self):
+        with self._lock:
+            if self._executor is None:
+                limit = settings.ROUTING_MAX_CONCURRENT_SEARCHES
+                self._slots = threading.BoundedSemaphore(limit)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=limit, thread_name_prefix='search-view')
+
+    def enter(self):
+        if self._executor is None:
+            self._setup()
+        return self._slots.acquire(blocking=False)
+
+    def leave(self):
+        self._slots.release()
+
+    def run(self, function, *args, **kwargs):
+        """Run ``function`` on the pool in the slot taken by ``enter()``.
+
+        The slot is given back when ``function`` finishes, not when the
+        caller stops waiting, so cancelled requests still count against the
+        limit while their search runs on.
+        """
+        try:
+            future = self._executor.submit(function, *args, **kwargs)
+        except BaseException:
+            self.leave()
+            raise
+        future.add_done_callback(lambda _: self.leave())
+        return asyncio.wrap_future(future)
+
+    def holding(self, iterable):
+        """Iterator over ``iterable`` that gives back the slot taken by
+        ``enter()`` once it is exhausted or closed, for responses that do
+        their work while they stream."""
+        return _SlotIterator(self, iterable)
+
+
+class _SlotIterator:
+    # A generator's finally clause does not run when it is closed before
+    # it starts, so the slot is released by close() itself, which Django
+    # calls on every response it sends or drops.
+
+    def __init__(self, limiter, iterable):
+        self._limiter = limiter
+        self._iterator = iter(iterable)
+        self._held = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self._held:
+            self._held = False
+            try:
+                if hasattr(self._iterator, 'close'):
+                    self._iterator.close()
+            finally:
+                self._limiter.leave()
+
+
+search_limiter = SearchLimiter()
+
+
+def busy_response():
+    response = JsonResponse(
+        {"detail": "Too many routing requests in progress, retry later."},
+        status=503)
+    response['Retry-After'] = str(settings.ROUTING_BUSY_RETRY_AFTER)
+    return response
+
+
+class OffloadedAPIView(APIView):
+    """APIView served by an async view that runs the whole request on
+    ``search_limiter``'s pool.
+
+    Under ASGI, sync views all share one thread, so a slow search would
+    hold up every other sync request. These views leave that thread at
+    once: they answer 503 with Retry-After when the pool is full and
+    otherwise await the pool.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+
+        def run(request, *args, **kwargs):
+            close_old_connections()
+            try:
+                response = view(request, *args, **kwargs)
+                if hasattr(response, 'render'):
+                    response.render()
+                return response
+            finally:
+                close_old_connections()
+
+        async def offloaded_view(request, *args, **kwargs):
+            if not search_limiter.enter():
+                return busy_response()
+            return await search_limiter.run(run, request, *args, **kwargs)
+
+        offloaded_view.cls = cls
+        offloaded_view.initkwargs = initkwargs
+        return csrf_exempt(offloaded_view)
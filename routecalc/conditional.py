@@ -0,0 +1,78 @@
+import hashlib
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import (get_conditional_response, patch_cache_control,
+                                patch_vary_headers)
+from .cache import VersionedLRUCache
+from .versioning import network_version
+
+response_cache = VersionedLRUCache('ROUTING_RESPONSE_CACHE_SIZE',
+                                   'ROUTING_RESPONSE_CACHE_TTL')
+
+
+def network_etag(version, key):
+    """Strong ETag of the representation ``key`` at network ``version``."""
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return f'"n{version}-{digest}"'
+
+
+class NetworkConditionalMixin:
+    """Serves GET requests for network data with an ETag derived from the
+    network version and a ``Cache-Control`` lifetime of
+    ``ROUTING_NETWORK_MAX_AGE`` seconds.
+
+    A matching ``If-None-Match`` gets a 304 before the view runs, and JSON
+    bodies are kept in ``conditional_cache`` until the version changes, so
+    repeat requests do not touch the database.
+
+    Views rendering from derived structures list them in
+    ``derived_structures``. While any of them is still being rebuilt for
+    the current version the view renders from the previous one, so its
+    response goes out without an ETag and is not cached.
+    """
+    conditional_cache = response_cache
+    derived_structures = ()
+
+    def structures_behind(self, version):
+        return any(cls._instance is not None and
+                   cls._instance.version != version
+                   for cls in self.derived_structures)
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super().dispatch(request, *args, **kwargs)
+        version = network_version()
+        key = (request.get_full_path(), request.META.get('HTTP_ACCEPT', ''))
+        etag = network_etag(version, key)
+        behind = self.structures_behind(version)
+        response = None
+        if not behind:
+            response = get_conditional_response(request, etag=etag)
+        if response is None:
+            cached = self.conditional_cache.get(key)
+            if cached is not None:
+                response = HttpResponse(cached[0], content_type=cached[1])
+            else:
+                response = super().dispatch(request, *args, **kwargs)
+                if hasattr(response, 'render'):
+                    response.render()
+                if not self.cacheable(response):
+                    return response
+                # A body read while the version moved on may predate it.
+                if (behind or self.structures_behind(version) or
+                        network_version() != version):
+                    return response
+                self.conditional_cache.put(
+                    key, (response.content, response['Content-Type']),
+                    version)
+        response['ETag'] = etag
+        patch_cache_control(response, public=True,
+                            max_age=settings.ROUTING_NETWORK_MAX_AGE)
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    def cacheable(self, response):
+        # The browsable API shows who is logged in, so only JSON is shared.
+        return (response.status_code == 200 and
+                response.get('Content-Type', '').startswith(
+                    'application/json'))
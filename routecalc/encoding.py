@@ -0,0 +1,54 @@
+import numpy as np
+
+GEOMETRY_FORMATS = ('points', 'polyline', 'delta')
+DEFAULT_PRECISION = 5
+MAX_PRECISION = 10
+
+
+def _scaled_deltas(coords, precision):
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    # Round half up, as the reference polyline encoder does.
+    values = np.floor(coords * 10.0 ** precision + 0.5).astype(np.int64)
+    return np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+
+
+def encode_polyline(coords, precision=DEFAULT_PRECISION):
+    """Encoded polyline of ``(x_coord, y_coord)`` pairs, in order."""
+    deltas = _scaled_deltas(coords, precision).ravel()
+    chunks = []
+    for value in ((deltas << 1) ^ (deltas >> 63)).tolist():
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def decode_polyline(encoded, precision=DEFAULT_PRECISION):
+    """``(n, 2)`` array of the pairs in an encoded polyline; the inverse of
+    ``encode_polyline`` up to ``precision``."""
+    values = []
+    value = shift = 0
+    for char in encoded:
+        chunk = ord(char) - 63
+        value |= (chunk & 0x1f) << shift
+        shift += 5
+        if chunk < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    deltas = np.array(values, dtype=np.int64).reshape(-1, 2)
+    return np.cumsum(deltas, axis=0) / 10.0 ** precision
+
+
+def delta_encode(coords, precision=DEFAULT_PRECISION):
+    """Flat ``[x0, y0, dx1, dy1, ...]`` list of integers scaled by
+    ``10 ** precision``; each pair is the offset from the previous one."""
+    return _scaled_deltas(coords, precision).ravel().tolist()
+
+
+def encode_coordinates(coords, geometry_format, precision=DEFAULT_PRECISION):
+    if geometry_format == 'polyline':
+        return encode_polyline(coords, precision)
+    if geometry_format == 'delta':
+        return delta_encode(coords, precision)
+    raise ValueError(f"Unknown geometry format {geometry_format!r}.")
@@ -0,0 +1,104 @@
+import logging
+import numpy as np
+from scipy.spatial import ConvexHull, QhullError
+from .encoding import encode_coordinates
+from .models import Route, Step, order_chains, unproject_coordinates
+from .versioning import DerivedStructure
+
+logger = logging.getLogger(__name__)
+
+
+def coverage_polygon(coords, radii, sides=16):
+    """Convex hull of circles of ``radii`` metres around projected
+    ``coords``, as a closed ring of ``(x_coord, y_coord)`` pairs. Empty
+    when there is no area to cover."""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    angles = np.linspace(0, 2 * np.pi, sides, endpoint=False)
+    circle = np.column_stack((np.cos(angles), np.sin(angles)))
+    outline = (coords[:, None, :] +
+               np.asarray(radii, dtype=float)[:, None, None] * circle)
+    outline = outline.reshape(-1, 2)
+    try:
+        ring = outline[ConvexHull(outline).vertices]
+    except (QhullError, ValueError):
+        return np.empty((0, 2))
+    ring = np.vstack((ring, ring[:1]))
+    return np.column_stack(unproject_coordinates(ring[:, 0], ring[:, 1]))
+
+
+def chain_order(steps):
+    """Rows of ``steps`` (``id``, ``next_id`` first) in riding order, route
+    by route, found by walking each route's ``next`` chain."""
+    by_id = steps[np.argsort(steps[:, 0], kind='stable')]
+    step_ids = by_id[:, 0].astype(np.int64)
+    chains = order_chains(
+        Route.objects.order_by('id').values_list('first_id', flat=True),
+        step_ids,
+        np.nan_to_num(by_id[:, 1], nan=-1).astype(np.int64)
+    )
+    if not chains:
+        return by_id[:0]
+    return by_id[np.concatenate(list(chains.values()))]
+
+
+def route_stops():
+    """``(route_ids, indptr, coords)``: the ``(x_coord, y_coord)`` stops of
+    every route in riding order, those of ``route_ids[i]`` being
+    ``coords[indptr[i]:indptr[i + 1]]``."""
+    steps = np.array(
+        Step.objects.order_by('route_id', 'sequence', 'id').values_list(
+            'id', 'next_id', 'route_id', 'sequence',
+            'point__x_coord', 'point__y_coord'),
+        dtype=np.float64
+    ).reshape(-1, 6)
+    if np.isnan(steps[:, 3]).any():
+        # Steps written in bulk, bypassing the signals that measure them,
+        # have no sequence yet; order everything by walking the chains.
+        steps = chain_order(steps)
+    route_of = steps[:, 2].astype(np.int64)
+    route_ids, starts = np.unique(route_of, return_index=True)
+    indptr = np.append(starts, len(route_of)).astype(np.int64)
+    return route_ids, indptr, steps[:, 4:6].copy()
+
+
+class RouteGeometry(DerivedStructure):
+    """Process-wide, ordered stop coordinates of every route.
+
+    Built from a single query over the Steps ordered by their stored
+    ``sequence``, so rendering a route never walks the ``next`` chain in the
+    database. The stops of route ``r`` are
+    ``coords[indptr[i]:indptr[i + 1]]`` with ``i`` its position in
+    ``route_ids``.
+    """
+    snapshot_fields = ('route_ids', 'indptr', 'coords')
+
+    def _build(self):
+        self.route_ids, self.indptr, self.coords = route_stops()
+        self._restore()
+        logger.info("Geometry built for %d routes.", len(self.route_ids))
+
+    def _restore(self):
+        self._encoded = {}
+
+    def route_index(self, route_id):
+        index = int(np.searchsorted(self.route_ids, route_id))
+        if index < len(self.route_ids) and self.route_ids[index] == route_id:
+            return index
+        return None
+
+    def coordinates(self, route_id):
+        """``(n, 2)`` array of the route's ``(x_coord, y_coord)`` stops in
+        riding order; empty for unknown routes."""
+        index = self.route_index(route_id)
+        if index is None:
+            return self.coords[:0]
+        return self.coords[self.indptr[index]:self.indptr[index + 1]]
+
+    def encoded(self, route_id, geometry_format, precision):
+        """The route's stops in a compact ``geometry_format``, encoded once
+        per built geometry and reused afterwards."""
+        key = (route_id, geometry_format, precision)
+        if key not in self._encoded:
+            self._encoded[key] = encode_coordinates(
+                self.coordinates(route_id), geometry_format, precision)
+        return self._encoded[key]
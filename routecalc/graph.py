@@ -0,0 +1,171 @@
+import logging
+import numpy as np
+from functools import cached_property
+from django.conf import settings
+from scipy.sparse import csr_matrix
+from scipy.spatial import KDTree
+from .models import Point, Route, Step, measure_chains
+from .versioning import DerivedStructure
+
+logger = logging.getLogger(__name__)
+
+
+class TransitGraph(DerivedStructure):
+    """Process-wide, array-backed view of the routing network.
+
+    Steps, points and routes are addressed by dense integer indices. The
+    transfer adjacency (every step standing on a given point) is kept in
+    CSR form: the steps at point ``p`` are
+    ``point_steps[point_indptr[p]:point_indptr[p + 1]]``. Walking transfers
+    between stops up to ``ROUTING_MAX_TRANSFER_WALK`` metres apart are kept
+    the same way in ``walk_indptr``/``walk_points``/``walk_lengths``.
+    """
+    snapshot_fields = (
+        'step_ids', 'point_ids', 'point_coords', 'point_xy', 'route_ids',
+        'step_next', 'step_point', 'step_route', 'edge_weight',
+        'step_cumulative', 'point_indptr', 'point_steps', 'prev_indptr',
+        'prev_steps', 'walk_indptr', 'walk_points', 'walk_lengths',
+    )
+    snapshot_settings = ('ROUTING_MAX_TRANSFER_WALK',)
+
+    def _build(self):
+        self._build_graph()
+
+    def _build_graph(self):
+        steps = np.array(
+            Step.objects.order_by('id').values_list(
+                'id', 'next_id', 'point_id', 'route_id',
+                'segment_length', 'cumulative_distance'),
+            dtype=np.float64
+        ).reshape(-1, 6)
+        self.point_ids, self.point_coords, self.point_xy = (
+            Point.objects.projected(raw=True))
+
+        self.step_ids = steps[:, 0].astype(np.int64)
+        self.route_ids = np.unique(steps[:, 3].astype(np.int64))
+
+        next_ids = steps[:, 1]
+        has_next = ~np.isnan(next_ids)
+        self.step_next = np.full(len(self.step_ids), -1, dtype=np.int32)
+        self.step_next[has_next] = np.searchsorted(
+            self.step_ids, next_ids[has_next].astype(np.int64))
+        self.step_point = np.searchsorted(
+            self.point_ids, steps[:, 2].astype(np.int64)).astype(np.int32)
+        self.step_route = np.searchsorted(
+            self.route_ids, steps[:, 3].astype(np.int64)).astype(np.int32)
+
+        self.edge_weight = np.ascontiguousarray(steps[:, 4])
+        self.step_cumulative = np.ascontiguousarray(steps[:, 5])
+        if (np.isnan(self.edge_weight).any() or
+                np.isnan(self.step_cumulative).any()):
+            # Steps written in bulk, bypassing the signals that measure
+            # them.
+            self.edge_weight, self.step_cumulative, _ = measure_chains(
+                Route.objects.values_list('first_id', flat=True),
+                self.step_ids,
+                np.nan_to_num(next_ids, nan=-1),
+                self.point_coords[self.step_point]
+            )
+
+        point_counts = np.bincount(self.step_point,
+                                   minlength=len(self.point_ids))
+        self.point_indptr = np.zeros(len(self.point_ids) + 1, dtype=np.int32)
+        np.cumsum(point_counts, out=self.point_indptr[1:])
+        self.point_steps = np.argsort(
+            self.step_point, kind='stable').astype(np.int32)
+
+        # Reverse ride edges, also in CSR form, for searches run backwards
+        # from the destination.
+        src = np.flatnonzero(self.step_next >= 0)
+        prev_counts = np.bincount(self.step_next[src],
+                                  minlength=len(self.step_ids))
+        self.prev_indptr = np.zeros(len(self.step_ids) + 1, dtype=np.int32)
+        np.cumsum(prev_counts, out=self.prev_indptr[1:])
+        self.prev_steps = src[np.argsort(
+            self.step_next[src], kind='stable')].astype(np.int32)
+
+        self._build_walks(point_counts > 0,
+                          settings.ROUTING_MAX_TRANSFER_WALK)
+        self._restore()
+        logger.info("Graph built with %d steps.", len(self.step_ids))
+
+    def _restore(self):
+        # Memoryviews index like lists and hand back plain Python numbers,
+        # which the pure-Python search loop needs to be fast, but they read
+        # the arrays in place: a graph mapped from a snapshot stays shared
+        # between workers instead of being copied into each of them.
+        self._next = memoryview(self.step_next)
+        self._point = memoryview(self.step_point)
+        self._route = memoryview(self.step_route)
+        self._weight = memoryview(self.edge_weight)
+        self._cumulative = memoryview(self.step_cumulative)
+        self._indptr = memoryview(self.point_indptr)
+        self._point_steps = memoryview(self.point_steps)
+        self._prev_indptr = memoryview(self.prev_indptr)
+        self._prev_steps = memoryview(self.prev_steps)
+        self._walk_indptr = memoryview(self.walk_indptr)
+        self._walk_points = memoryview(self.walk_points)
+        self._walk_lengths = memoryview(self.walk_lengths)
+
+    def _build_walks(self, is_stop, max_walk):
+        stops = np.flatnonzero(is_stop)
+        if max_walk > 0 and len(stops) > 1:
+            pairs = KDTree(self.point_coords[stops]).query_pairs(
+                max_walk, output_type='ndarray')
+        else:
+            pairs = np.empty((0, 2), dtype=np.intp)
+        origins = np.concatenate((stops[pairs[:, 0]], stops[pairs[:, 1]]))
+        targets = np.concatenate((stops[pairs[:, 1]], stops[pairs[:, 0]]))
+        order = np.lexsort((targets, origins))
+        origins, targets = origins[order], targets[order]
+        counts = np.bincount(origins, minlength=len(self.point_ids))
+        self.walk_indptr = np.zeros(len(self.point_ids) + 1, dtype=np.int32)
+        np.cumsum(counts, out=self.walk_indptr[1:])
+        self.walk_points = targets.astype(np.int32)
+        self.walk_lengths = np.linalg.norm(
+            self.point_coords[targets] - self.point_coords[origins], axis=1)
+
+    def point_index(self, point_id):
+        index = int(np.searchsorted(self.point_ids, point_id))
+        if index < len(self.point_ids) and self.point_ids[index] == point_id:
+            return index
+        return None
+
+    def steps_at(self, point_index):
+        return self._point_steps[
+            self._indptr[point_index]:self._indptr[point_index + 1]]
+
+    def steps_before(self, step):
+        return self._prev_steps[
+            self._prev_indptr[step]:self._prev_indptr[step + 1]]
+
+    def walks_from(self, point_index):
+        start = self._walk_indptr[point_index]
+        end = self._walk_indptr[point_index + 1]
+        return zip(self._walk_points[start:end], self._walk_lengths[start:end])
+
+    @cached_property
+    def csgraph(self):
+        """Sparse adjacency for ``scipy.sparse.csgraph``, weighted in metres.
+
+        Nodes ``0..len(point_ids) - 1`` are points and the following
+        ``len(step_ids)`` nodes are steps. A point reaches each step standing
+        on it and each step reaches its point at no cost, so transfers are
+        free; rides follow ``step_next`` and walks the walking transfers.
+        """
+        points = len(self.point_ids)
+        steps = np.arange(len(self.step_ids))
+        rides = np.flatnonzero(self.step_next >= 0)
+        walk_origins = np.repeat(np.arange(points),
+                                 np.diff(self.walk_indptr))
+        rows = np.concatenate((self.step_point, points + steps,
+                               points + rides, walk_origins))
+        cols = np.concatenate((points + steps, self.step_point,
+                               points + self.step_next[rides],
+                               self.walk_points))
+        # Explicit zeros are kept as edges by csgraph.
+        weights = np.concatenate((np.zeros(2 * len(steps)),
+                                  self.edge_weight[rides],
+                                  self.walk_lengths))
+        size = points + len(steps)
+        return csr_matrix((weights, (rows, cols)), shape=(size, size))
@@ -0,0 +1,335 @@
+import io
+import json
+import re
+import numpy as np
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from .models import (Line, Point, Route, Step, chain_sequence,
+                     measure_chains, project_coordinates)
+from .spatial_index import PointSpatialIndex
+from .versioning import bump_network_version
+
+# Insertion order; the foreign keys between them are only checked at commit.
+NETWORK_MODELS = (Line, Point, Route, Step)
+STAGED_SUFFIX = '__staged'
+REPLACED_SUFFIX = '__replaced'
+_SEPARATOR = re.compile(r'[\s,]*')
+
+
+def iter_fixture(stream, chunk_size=1 << 16):
+    """Yield the objects of the JSON array in ``stream`` one at a time,
+    reading it in chunks instead of parsing the whole document."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    # Chunks may hold nothing but the whitespace before the array.
+    for chunk in iter(lambda: stream.read(chunk_size), ''):
+        buffer = chunk.lstrip()
+        if buffer:
+            break
+    if not buffer.startswith('['):
+        raise ValueError("The fixture is not a JSON array.")
+    position = 1
+    exhausted = False
+    while True:
+        position = _SEPARATOR.match(buffer, position).end()
+        if buffer.startswith(']', position):
+            return
+        try:
+            obj, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if exhausted:
+                raise
+            chunk = stream.read(chunk_size)
+            exhausted = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield obj
+
+
+def _missing(ids, known):
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    return ids[~np.isin(ids, known)]
+
+
+class NetworkDump:
+    """A network fixture held as arrays, with the ``next`` chains and the
+    circular ``Route.first`` references checked in memory and every step
+    measured, ready to be written in bulk."""
+
+    def __init__(self, records):
+        self.lines = {}
+        self.routes = {}
+        points = []
+        steps = []
+        self.skipped = 0
+        for record in records:
+            model, pk, fields = (record.get('model'), record.get('pk'),
+                                 record.get('fields', {}))
+            if model == 'routecalc.point':
+                points.append((pk, fields['x_coord'], fields['y_coord']))
+            elif model == 'routecalc.step':
+                steps.append((pk, fields['route'], fields['point'],
+                              -1 if fields.get('next') is None
+                              else fields['next']))
+            elif model == 'routecalc.route':
+                self.routes[pk] = fields
+            elif model == 'routecalc.line':
+                self.lines[pk] = fields
+            else:
+                self.skipped += 1
+
+        points = np.array(sorted(points), dtype=np.float64).reshape(-1, 3)
+        steps = np.array(sorted(steps), dtype=np.int64).reshape(-1, 4)
+        self.point_ids = points[:, 0].astype(np.int64)
+        self.point_x, self.point_y = points[:, 1], points[:, 2]
+        self.step_ids, self.step_route, self.step_point, self.step_next = (
+            steps.T)
+        for name, ids in (("point", self.point_ids), ("step", self.step_ids)):
+            if len(np.unique(ids)) != len(ids):
+                raise ValueError(f"Duplicate {name} ids in the fixture.")
+        self._check()
+
+        self.point_utm = np.column_stack(project_coordinates(
+            self.point_x, self.point_y)).reshape(-1, 2)
+        first_ids = [fields['first'] for fields in self.routes.values()]
+        coords = self.point_utm[np.searchsorted(self.point_ids,
+                                                self.step_point)]
+        self.segment, self.cumulative, _ = measure_chains(
+            first_ids, self.step_ids, self.step_next, coords)
+        self.sequence = chain_sequence(first_ids, self.step_ids,
+                                       self.step_next)
+
+    def _check(self):
+        route_ids = np.array(sorted(self.routes), dtype=np.int64)
+        has_next = self.step_next >= 0
+        problems = [
+            ("Steps reference missing points",
+             _missing(self.step_point, self.point_ids)),
+            ("Steps reference missing routes",
+             _missing(self.step_route, route_ids)),
+            ("Steps reference missing next steps",
+             _missing(self.step_next[has_next], self.step_ids)),
+            ("Routes reference missing lines",
+             _missing([fields['line'] for fields in self.routes.values()],
+                      list(self.lines))),
+        ]
+        step_routes = dict(zip(self.step_ids.tolist(),
+                               self.step_route.tolist()))
+        problems += [
+            ("Routes start at missing steps",
+             np.array([fields['first'] for fields in self.routes.values()
+                       if fields['first'] not in step_routes],
+                      dtype=np.int64)),
+            ("Routes start at a step of another route",
+             np.array([pk for pk, fields in self.routes.items()
+                       if step_routes.get(fields['first'], pk) != pk],
+                      dtype=np.int64)),
+        ]
+        for message, ids in problems:
+            if len(ids):
+                raise ValueError(
+                    f"{message}: {', '.join(map(str, ids[:10].tolist()))}"
+                    f"{' ...' if len(ids) > 10 else ''}.")
+
+    def counts(self):
+        return {Line: len(self.lines), Point: len(self.point_ids),
+                Route: len(self.routes), Step: len(self.step_ids)}
+
+    def objects(self, model):
+        """Unsaved instances of ``model``, in primary key order."""
+        if model is Line:
+            for pk in sorted(self.lines):
+                yield Line(id=pk, name=self.lines[pk]['name'],
+                           color=self.lines[pk]['color'])
+        elif model is Point:
+            for pk, x, y, (x_utm, y_utm) in zip(
+                    self.point_ids.tolist(), self.point_x.tolist(),
+                    self.point_y.tolist(), self.point_utm.tolist()):
+                yield Point(id=pk, x_coord=x, y_coord=y, x_utm=x_utm,
+                            y_utm=y_utm)
+        elif model is Route:
+            for pk in sorted(self.routes):
+                fields = self.routes[pk]
+                yield Route(id=pk, line_id=fields['line'],
+                            isReturn=fields['isReturn'],
+                            distance=fields['distance'],
+                            time=fields['time'], first_id=fields['first'])
+        elif model is Step:
+            for pk, route, point, next_id, length, distance, position in (
+                    zip(self.step_ids.tolist(), self.step_route.tolist(),
+                        self.step_point.tolist(), self.step_next.tolist(),
+                        self.segment.tolist(), self.cumulative.tolist(),
+                        self.sequence.tolist())):
+                yield Step(id=pk, route_id=route, point_id=point,
+                           next_id=None if next_id < 0 else next_id,
+                           segment_length=length,
+                           cumulative_distance=(None if np.isnan(distance)
+                                                else distance),
+                           sequence=None if position < 0 else position)
+
+
+def _reset_sequences(cursor):
+    for sql in connection.ops.sequence_reset_sql(no_style(), NETWORK_MODELS):
+        cursor.execute(sql)
+
+
+def replace_network(dump, batch_size=2000):
+    """Replace every network table with ``dump`` in one transaction.
+
+    Other connections keep reading the old network until the commit on
+    databases with MVCC, such as PostgreSQL.
+    """
+    quote = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        for model in reversed(NETWORK_MODELS):
+            cursor.execute(f"DELETE FROM {quote(model._meta.db_table)}")
+        for model in NETWORK_MODELS:
+            model.objects.bulk_create(dump.objects(model),
+                                      batch_size=batch_size)
+        _reset_sequences(cursor)
+        bump_network_version()
+
+
+def import_route(line, is_return, time, coords, snap_tolerance):
+    """Create a route along ``coords``, ``(x_coord, y_coord)`` pairs in
+    riding order, with one Step per coordinate.
+
+    Coordinates within ``snap_tolerance`` metres of an existing point reuse
+    it; the others get new points. Everything is written with bulk inserts
+    in one transaction, with the steps measured and ``Route.distance`` set
+    to the length of the chain in kilometres. Returns the route and the
+    number of points created.
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    snapped = PointSpatialIndex().snap(coords[:, 0], coords[:, 1],
+                                       radius_meters=snap_tolerance, k=1,
+                                       fallback_nearest=False)
+    point_ids = np.array([ids[0] if len(ids) else -1 for ids, _ in snapped],
+                         dtype=np.int64)
+    with transaction.atomic():
+        # The index may predate deletions; only points still there count.
+        known_ids, known_utm = Point.objects.filter(
+            id__in=np.unique(point_ids[point_ids >= 0]).tolist()).projected()
+        utm = np.empty_like(coords)
+        reused = np.isin(point_ids, known_ids)
+        utm[reused] = known_utm[np.searchsorted(known_ids,
+                                                point_ids[reused])]
+        created = Point.objects.bulk_create(
+            [Point(x_coord=x, y_coord=y)
+             for x, y in coords[~reused].tolist()])
+        point_ids[~reused] = [point.id for point in created]
+        utm[~reused] = [(point.x_utm, point.y_utm) for point in created]
+
+        segment = np.zeros(len(coords))
+        segment[:-1] = np.linalg.norm(np.diff(utm, axis=0), axis=1)
+        cumulative = np.concatenate(([0.0], np.cumsum(segment[:-1])))
+        # Route.first and Step.route point at each other; the placeholder
+        # is replaced before the deferred constraint is checked at commit.
+        route, = Route.objects.bulk_create([Route(
+            line=line, isReturn=is_return, time=time,
+            distance=float(segment.sum()) / 1000.0, first_id=0)])
+        steps = Step.objects.bulk_create(
+            [Step(route=route, point_id=point_id, segment_length=length,
+                  cumulative_distance=distance, sequence=position)
+             for position, (point_id, length, distance) in enumerate(zip(
+                 point_ids.tolist(), segment.tolist(),
+                 cumulative.tolist()))])
+        for step, following in zip(steps, steps[1:]):
+            step.next_id = following.id
+        Step.objects.bulk_update(steps[:-1], ['next'], batch_size=1000)
+        route.first_id = steps[0].id
+        Route.objects.filter(pk=route.pk).update(first_id=route.first_id)
+        bump_network_version()
+    return route, len(created)
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_rows(cursor, table, columns, rows):
+    """Write ``rows`` to ``table`` with PostgreSQL's ``COPY``, through
+    either psycopg 3 or psycopg2."""
+    sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN"
+    if hasattr(cursor, 'copy'):
+        with cursor.copy(sql) as copy:
+            for row in rows:
+                copy.write_row(row)
+        return
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(map(_copy_value, row)) + '\n')
+    buffer.seek(0)
+    cursor.copy_expert(sql, buffer)
+
+
+def replace_network_staged(dump):
+    """Load ``dump`` into staging copies of the network tables, then swap
+    them in. PostgreSQL only.
+
+    The live tables stay readable and writable while the staging tables
+    are filled, indexed and their foreign keys validated; they are only
+    locked for the renames at the end.
+    """
+    if connection.vendor != 'postgresql':
+        raise ValueError(
+            "A staged import needs PostgreSQL; import without staging.")
+    quote = connection.ops.quote_name
+    tables = {model: model._meta.db_table for model in NETWORK_MODELS}
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for table in tables.values():
+            staged = quote(table + STAGED_SUFFIX)
+            cursor.execute(f"DROP TABLE IF EXISTS {staged} CASCADE")
+            cursor.execute(f"CREATE TABLE {staged} "
+                           f"(LIKE {quote(table)} INCLUDING ALL)")
+        for model, table in tables.items():
+            fields = model._meta.concrete_fields
+            copy_rows(cursor, quote(table + STAGED_SUFFIX),
+                      [quote(field.column) for field in fields],
+                      ([getattr(obj, field.attname) for field in fields]
+                       for obj in dump.objects(model)))
+        # LIKE does not copy foreign keys. They are added, and checked,
+        # between the staging tables so that they survive the renames.
+        for model, table in tables.items():
+            for field in model._meta.concrete_fields:
+                if field.remote_field is None:
+                    continue
+                target = field.remote_field.model
+                cursor.execute(
+                    f"ALTER TABLE {quote(table + STAGED_SUFFIX)} "
+                    f"ADD CONSTRAINT {quote(f'{table}_{field.column}_fk')} "
+                    f"FOREIGN KEY ({quote(field.column)}) REFERENCES "
+                    f"{quote(tables[target] + STAGED_SUFFIX)} "
+                    f"({quote(target._meta.pk.column)})"
+                    f"{connection.ops.deferrable_sql()}")
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {', '.join(map(quote, tables.values()))} "
+                       f"IN ACCESS EXCLUSIVE MODE")
+        for model, table in tables.items():
+            pk = model._meta.pk.column
+            cursor.execute("SELECT pg_get_serial_sequence(%s, %s)",
+                           [quote(table), pk])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(f"ALTER TABLE {quote(table)} "
+                           f"RENAME TO {quote(table + REPLACED_SUFFIX)}")
+            cursor.execute(f"ALTER TABLE {quote(table + STAGED_SUFFIX)} "
+                           f"RENAME TO {quote(table)}")
+            cursor.execute("SELECT pg_get_serial_sequence(%s, %s)",
+                           [quote(table), pk])
+            if sequence and cursor.fetchone()[0] is None:
+                # A serial column: the copied default still draws from the
+                # old table's sequence, which must outlive that table.
+                cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY "
+                               f"{quote(table)}.{quote(pk)}")
+        cursor.execute(
+            f"DROP TABLE "
+            f"{', '.join(quote(t + REPLACED_SUFFIX) for t in tables.values())}"
+            f" CASCADE")
+        _reset_sequences(cursor)
+        bump_network_version()
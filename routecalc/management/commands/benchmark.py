@@ -0,0 +1,301 @@
+import json
+import platform
+import resource
+import threading
+import time
+import tracemalloc
+from io import StringIO
+import django
+import numpy as np
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import Client, override_settings
+from django.test.utils import (setup_databases, setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+from routecalc.graph import TransitGraph
+from routecalc.models import Line
+from routecalc.rendering import RiddenPath, render_paths
+from routecalc.routing import calculatePaths, find_best_path, search_paths
+from routecalc.spatial_index import PointSpatialIndex
+from routecalc.versioning import DerivedStructure
+
+SNAP_RADIUS = 300.0
+SWITCH_COST = 200.0
+WALKING_MULTIPLIER = 5
+
+
+class QueryCounter:
+    """Counts SQL queries on every connection, including the ones opened
+    by the routing views' worker threads."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def parse_query(line):
+    query = json.loads(line)
+    if 'path' in query:
+        # A logged request: /api/routes/best/<o_x>/<o_y>/<d_x>/<d_y>
+        parts = query['path'].split('?')[0].rstrip('/').split('/')[-4:]
+        query = dict(zip(('o_x', 'o_y', 'd_x', 'd_y'), parts))
+    return tuple(float(str(query[key]).replace(',', '.'))
+                 for key in ('o_x', 'o_y', 'd_x', 'd_y'))
+
+
+def summarize(durations, queries, peak):
+    durations = np.asarray(durations) * 1000.0
+    p50, p95, p99 = np.percentile(durations, [50, 95, 99]).tolist()
+    return {
+        "count": len(durations),
+        "mean_ms": float(durations.mean()),
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "queries_per_call": queries / len(durations),
+        "peak_memory_kb": peak / 1024.0,
+    }
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the routing stages and views on a throwaway database "
+            "loaded from a fixture, and write latency percentiles, queries "
+            "per call and peak memory to a JSON file.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fixture', default='data_dump.json',
+                            help="Fixture loaded into the test database.")
+        parser.add_argument('--current-db', action='store_true',
+                            help="Use the configured database as it is "
+                                 "instead of a test database.")
+        parser.add_argument('--replay',
+                            help="JSON-lines file of queries, each with "
+                                 "o_x, o_y, d_x and d_y or a best-route "
+                                 "'path'.")
+        parser.add_argument('--queries', type=int, default=100,
+                            help="Random queries generated without "
+                                 "--replay.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--save-queries',
+                            help="Write the queries used as JSON lines.")
+        parser.add_argument('--memory-samples', type=int, default=20,
+                            help="Calls per stage repeated under "
+                                 "tracemalloc for peak memory.")
+        parser.add_argument('--output', default='benchmark.json')
+        parser.add_argument('--compare',
+                            help="Earlier results to print changes "
+                                 "against.")
+
+    def handle(self, *args, **options):
+        # The view stages use the test client, whose host has to be allowed
+        # whichever database is used.
+        setup_test_environment()
+        try:
+            if options['current_db']:
+                return self.run(options)
+            old_config = setup_databases(verbosity=0, interactive=False,
+                                         aliases={'default'})
+            try:
+                call_command('importnetwork', options['fixture'],
+                             stdout=StringIO())
+                return self.run(options)
+            finally:
+                teardown_databases(old_config, verbosity=0)
+        finally:
+            teardown_test_environment()
+
+    def run(self, options):
+        for cls in DerivedStructure.registry:
+            cls._instance = None
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        counter.install(None, connection)
+
+        builds = {}
+        for cls in DerivedStructure.registry:
+            started = time.perf_counter()
+            cls()
+            builds[cls.__name__] = (time.perf_counter() - started) * 1000.0
+
+        queries = self.load_queries(options)
+        if options['save_queries']:
+            with open(options['save_queries'], 'w') as output:
+                for o_x, o_y, d_x, d_y in queries:
+                    output.write(json.dumps(
+                        {"o_x": o_x, "o_y": o_y, "d_x": d_x, "d_y": d_y}) +
+                        "\n")
+
+        results = {}
+        with override_settings(ROUTING_PATH_CACHE_SIZE=0,
+                               ROUTING_RESPONSE_CACHE_SIZE=0):
+            for name, stage in self.stages(queries):
+                results[name] = self.measure(
+                    stage, queries, counter, options['memory_samples'])
+                self.stdout.write(
+                    f"{name:>16}: p50 {results[name]['p50_ms']:8.2f} ms  "
+                    f"p95 {results[name]['p95_ms']:8.2f} ms  "
+                    f"p99 {results[name]['p99_ms']:8.2f} ms  "
+                    f"{results[name]['queries_per_call']:6.1f} queries")
+        connection_created.disconnect(counter.install)
+
+        report = {
+            "meta": {
+                "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                "database": connection.vendor,
+                "fixture": (None if options['current_db']
+                            else options['fixture']),
+                "queries": len(queries),
+                "seed": None if options['replay'] else options['seed'],
+                "replay": options['replay'],
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "max_rss_kb": resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss,
+                "build_ms": builds,
+            },
+            "stages": results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+        self.stdout.write(self.style.SUCCESS(
+            f"Results written to {options['output']}."))
+        if options['compare']:
+            self.compare(options['compare'], results)
+
+    def load_queries(self, options):
+        if options['replay']:
+            with open(options['replay']) as lines:
+                queries = [parse_query(line) for line in lines
+                           if line.strip()]
+            if not queries:
+                raise CommandError("No queries to replay.")
+            return queries
+        # Random trips between stops, a few metres off each stop.
+        graph = TransitGraph()
+        stops = graph.point_xy[np.unique(graph.step_point)]
+        if not len(stops):
+            raise CommandError("The network has no stops.")
+        rng = np.random.default_rng(options['seed'])
+        picks = rng.integers(len(stops), size=(options['queries'], 2))
+        jitter = rng.uniform(-0.0005, 0.0005, size=(options['queries'], 4))
+        coords = np.hstack((stops[picks[:, 0]], stops[picks[:, 1]])) + jitter
+        return [tuple(row) for row in coords.tolist()]
+
+    def stages(self, queries):
+        client = Client()
+        line_ids = list(Line.objects.order_by('id').values_list(
+            'id', flat=True)) or [0]
+
+        def snapped(o_x, o_y, d_x, d_y):
+            (start_ids, start_dists), (end_ids, end_dists) = (
+                PointSpatialIndex().snap([o_x, d_x], [o_y, d_y],
+                                         radius_meters=SNAP_RADIUS))
+            return (start_ids.tolist(), end_ids.tolist(),
+                    dict(zip(start_ids.tolist(), start_dists.tolist())),
+                    dict(zip(end_ids.tolist(), end_dists.tolist())))
+
+        prepared = [snapped(*query) for query in queries]
+        graph = TransitGraph()
+        searched = [search_paths(graph, *snaps, 5, SWITCH_COST,
+                                 WALKING_MULTIPLIER)
+                    for snaps in prepared]
+
+        def snap(i):
+            snapped(*queries[i])
+
+        def best_path(i):
+            start_ids, end_ids, start_costs, end_costs = prepared[i]
+            start = {graph.point_index(p): c * WALKING_MULTIPLIER
+                     for p, c in start_costs.items()}
+            end = {graph.point_index(p): c * WALKING_MULTIPLIER
+                   for p, c in end_costs.items()}
+            start.pop(None, None)
+            end.pop(None, None)
+            find_best_path(graph, [s for p in start
+                                   for s in graph.steps_at(p)],
+                           end, SWITCH_COST, start,
+                           settings.ROUTING_SEARCH_MODE, WALKING_MULTIPLIER)
+
+        def calculate(i):
+            calculatePaths(*prepared[i], 5, SWITCH_COST, WALKING_MULTIPLIER)
+
+        def render(i):
+            _, _, start_costs, end_costs = prepared[i]
+            render_paths([RiddenPath(graph, path, distance, start_costs,
+                                     end_costs)
+                          for path, distance in searched[i]],
+                         start_costs, end_costs, *queries[i])
+
+        def view(url):
+            def get(i):
+                response = client.get(url(*queries[i], i))
+                if response.status_code != 200:
+                    raise CommandError(
+                        f"{response.status_code} from {url(*queries[i], i)}")
+            return get
+
+        yield 'snap', snap
+        yield 'find_best_path', best_path
+        yield 'calculatePaths', calculate
+        yield 'render_paths', render
+        yield 'view:best', view(
+            lambda o_x, o_y, d_x, d_y, i:
+            f'/api/routes/best/{o_x!r}/{o_y!r}/{d_x!r}/{d_y!r}')
+        yield 'view:range', view(
+            lambda o_x, o_y, d_x, d_y, i:
+            f'/api/routes/range/{o_x!r}/{o_y!r}/{SNAP_RADIUS!r}')
+        yield 'view:reach', view(
+            lambda o_x, o_y, d_x, d_y, i:
+            f'/api/routes/reach/{o_x!r}/{o_y!r}/3000')
+        yield 'view:line', view(
+            lambda o_x, o_y, d_x, d_y, i:
+            f'/api/lines/{line_ids[i % len(line_ids)]}/routes')
+
+    def measure(self, stage, queries, counter, memory_samples):
+        durations = []
+        before = counter.count
+        for i in range(len(queries)):
+            started = time.perf_counter()
+            stage(i)
+            durations.append(time.perf_counter() - started)
+        executed = counter.count - before
+
+        # A separate pass, since tracemalloc slows everything down.
+        peak = 0
+        tracemalloc.start()
+        try:
+            for i in range(min(memory_samples, len(queries))):
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                stage(i)
+                peak = max(peak, tracemalloc.get_traced_memory()[1] -
+                           baseline)
+        finally:
+            tracemalloc.stop()
+        return summarize(durations, executed, peak)
+
+    def compare(self, path, results):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)['stages']
+        self.stdout.write(f"Compared with {path}:")
+        for name, current in results.items():
+            if name not in baseline:
+                continue
+            changes = '  '.join(
+                f"{key[:-3]} "
+                f"{100.0 * (current[key] / baseline[name][key] - 1):+6.1f}%"
+                for key in ('p50_ms', 'p95_ms', 'p99_ms')
+                if baseline[name][key])
+            self.stdout.write(f"{name:>16}: {changes}")
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from routecalc.geometry import RouteGeometry
+from routecalc.graph import TransitGraph
+from routecalc.models import NetworkVersion
+from routecalc.rendering import RouteMetadata
+from routecalc.snapshot import prune_snapshots, write_snapshot
+from routecalc.spatial_index import PointSpatialIndex, RouteSpatialIndex
+from routecalc.versioning import network_version
+
+STRUCTURES = (TransitGraph, PointSpatialIndex, RouteSpatialIndex,
+              RouteGeometry, RouteMetadata)
+
+
+class Command(BaseCommand):
+    help = ("Build the derived routing structures from the database and "
+            "write them as a memory-mappable snapshot in "
+            "ROUTING_SNAPSHOT_DIR, shared by every worker process.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=2,
+                            help="Snapshots kept, newest first; older ones "
+                                 "are deleted.")
+        parser.add_argument('--attempts', type=int, default=3,
+                            help="Builds tried while the network keeps "
+                                 "changing underneath.")
+
+    def handle(self, *args, **options):
+        if not settings.ROUTING_SNAPSHOT_DIR:
+            raise CommandError("ROUTING_SNAPSHOT_DIR is not set.")
+        for _ in range(options['attempts']):
+            version = network_version(refresh=True)
+            instances = [cls._create(use_snapshot=False)
+                         for cls in STRUCTURES]
+            if (all(instance.version == version for instance in instances)
+                    and NetworkVersion.current() == version):
+                break
+            self.stdout.write(self.style.WARNING(
+                "The network changed during the build, retrying."))
+        else:
+            raise CommandError("The network kept changing; no snapshot "
+                               "written.")
+        path = write_snapshot(instances, version)
+        removed = prune_snapshots(options['keep'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Snapshot of network version {version} written to {path} "
+            f"({', '.join(cls.__name__ for cls in STRUCTURES)}); "
+            f"{len(removed)} older snapshots removed."))
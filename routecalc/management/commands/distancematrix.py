@@ -0,0 +1,51 @@
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from routecalc.graph import TransitGraph
+from routecalc.matrix import write_json, write_npy
+
+
+def id_list(value):
+    return [int(part) for part in value.split(',') if part.strip()]
+
+
+class Command(BaseCommand):
+    help = ("Write the stop-to-stop network distance matrix, in metres, to "
+            "a .npy or .json file, computing it in chunks of origin rows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Path ending in .npy or .json.")
+        parser.add_argument(
+            '--origins', type=id_list,
+            help="Comma-separated point ids. Defaults to every stop.")
+        parser.add_argument(
+            '--destinations', type=id_list,
+            help="Comma-separated point ids. Defaults to the origins.")
+        parser.add_argument('--chunk-size', type=int, default=256,
+                            help="Origin rows computed and written at once.")
+
+    def handle(self, *args, **options):
+        output = options['output']
+        if output.endswith('.npy'):
+            write = write_npy
+        elif output.endswith('.json'):
+            write = write_json
+        else:
+            raise CommandError("Output must end in .npy or .json.")
+        graph = TransitGraph()
+        origins = options['origins']
+        if origins is None:
+            origins = graph.point_ids[np.unique(graph.step_point)].tolist()
+        destinations = options['destinations'] or origins
+        try:
+            write(output, graph, origins, destinations,
+                  options['chunk_size'])
+        except KeyError as error:
+            raise CommandError(f"Unknown points {error}.")
+        if write is write_npy:
+            # Row and column ids, in the order of the matrix.
+            ids_path = output[:-len('.npy')] + '.ids.npz'
+            np.savez(ids_path, origins=origins, destinations=destinations)
+            self.stdout.write(f"Point ids written to {ids_path}.")
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote a {len(origins)} x {len(destinations)} matrix to "
+            f"{output}."))
@@ -0,0 +1,50 @@
+import gzip
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from routecalc.importing import (NetworkDump, iter_fixture, replace_network,
+                                 replace_network_staged)
+from routecalc.models import NetworkVersion
+
+
+class Command(BaseCommand):
+    help = ("Replace the routing network with the lines, points, routes and "
+            "steps of a dumpdata fixture, streamed and written in bulk with "
+            "the projections, segment lengths and sequence numbers already "
+            "computed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('fixture', nargs='?', default='data_dump.json',
+                            help="JSON fixture, optionally gzipped (.gz).")
+        parser.add_argument('--staged', action='store_true',
+                            help="Load into staging tables and swap them "
+                                 "in, so the live network is only locked "
+                                 "for the swap (PostgreSQL only).")
+        parser.add_argument('--batch-size', type=int, default=2000,
+                            help="Rows per INSERT without --staged.")
+
+    def handle(self, *args, **options):
+        if options['staged'] and connection.vendor != 'postgresql':
+            raise CommandError("A staged import needs PostgreSQL; import "
+                               "without --staged.")
+        path = options['fixture']
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            with opener(path, 'rt', encoding='utf-8') as stream:
+                dump = NetworkDump(iter_fixture(stream))
+        except OSError as error:
+            raise CommandError(f"Cannot read {path}: {error}")
+        except (KeyError, TypeError, ValueError) as error:
+            raise CommandError(f"Invalid network fixture {path}: {error!r}")
+        if dump.skipped:
+            self.stdout.write(self.style.WARNING(
+                f"Skipped {dump.skipped} objects of other models."))
+
+        if options['staged']:
+            replace_network_staged(dump)
+        else:
+            replace_network(dump, options['batch_size'])
+        counts = ', '.join(f"{count} {model._meta.verbose_name_plural}"
+                           for model, count in dump.counts().items())
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts}; network version "
+            f"{NetworkVersion.current()}."))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from routecalc.models import Route
+
+
+class Command(BaseCommand):
+    help = ("Recompute sequence numbers, segment lengths and cumulative "
+            "distances of every Step and check Route.distance against the "
+            "route geometry.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tolerance', type=float, default=0.1,
+            help="Relative difference between Route.distance (km) and the "
+                 "measured geometry that is reported as a mismatch.")
+
+    def handle(self, *args, **options):
+        tolerance = options['tolerance']
+        lengths = Route.objects.all().measure()
+        mismatches = 0
+        for route in Route.objects.filter(id__in=lengths).order_by('id'):
+            measured_km = lengths[route.id] / 1000.0
+            if not route.distance:
+                continue
+            difference = abs(measured_km - route.distance) / route.distance
+            if difference > tolerance:
+                mismatches += 1
+                self.stdout.write(self.style.WARNING(
+                    f"Route {route.id}: distance={route.distance:.2f} km, "
+                    f"geometry={measured_km:.2f} km"))
+        self.stdout.write(self.style.SUCCESS(
+            f"Measured {len(lengths)} routes, {mismatches} mismatches."))
@@ -0,0 +1,78 @@
+import json
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.sparse.csgraph import dijkstra
+
+
+def point_indices(graph, point_ids):
+    """Graph indices of ``point_ids``; raises ``KeyError`` listing the ids
+    that are not in the graph."""
+    point_ids = np.asarray(point_ids, dtype=np.int64)
+    indices = np.searchsorted(graph.point_ids, point_ids)
+    found = indices < len(graph.point_ids)
+    found[found] = graph.point_ids[indices[found]] == point_ids[found]
+    if not found.all():
+        raise KeyError(point_ids[~found].tolist())
+    return indices
+
+
+def distance_rows(graph, origin_ids, destination_ids, chunk_size=256):
+    """Yield ``(start, block)`` pairs covering the network distance matrix
+    in metres, ``block`` holding the rows of ``chunk_size`` origins from
+    ``start`` on; unreachable destinations are ``inf``."""
+    # Resolve the ids before the first block is asked for, so unknown ids
+    # fail before any output is written.
+    origins = point_indices(graph, origin_ids)
+    destinations = point_indices(graph, destination_ids)
+
+    def blocks():
+        for start in range(0, len(origins), chunk_size):
+            block = dijkstra(graph.csgraph, directed=True,
+                             indices=origins[start:start + chunk_size])
+            yield start, block[:, destinations]
+
+    return blocks()
+
+
+def distance_matrix(graph, origin_ids, destination_ids):
+    matrix = np.empty((len(origin_ids), len(destination_ids)))
+    for start, block in distance_rows(graph, origin_ids, destination_ids):
+        matrix[start:start + len(block)] = block
+    return matrix
+
+
+def matrix_json(origin_ids, destination_ids, rows):
+    """JSON-ready matrix, ``None`` standing for unreachable pairs."""
+    return {
+        "origins": list(origin_ids),
+        "destinations": list(destination_ids),
+        "distances": [[None if np.isinf(d) else d for d in row]
+                      for row in np.asarray(rows).tolist()],
+    }
+
+
+def write_npy(path, graph, origin_ids, destination_ids, chunk_size=256):
+    """Write the matrix as float32 ``.npy`` one chunk of rows at a time."""
+    rows = distance_rows(graph, origin_ids, destination_ids, chunk_size)
+    matrix = open_memmap(path, mode='w+', dtype=np.float32,
+                         shape=(len(origin_ids), len(destination_ids)))
+    for start, block in rows:
+        matrix[start:start + len(block)] = block
+        matrix.flush()
+    del matrix
+
+
+def write_json(path, graph, origin_ids, destination_ids, chunk_size=256):
+    """Write the same layout as ``matrix_json`` one chunk of rows at a
+    time."""
+    rows = distance_rows(graph, origin_ids, destination_ids, chunk_size)
+    with open(path, 'w') as output:
+        output.write('{"origins": %s, "destinations": %s, "distances": ['
+                     % (json.dumps(list(origin_ids)),
+                        json.dumps(list(destination_ids))))
+        separator = ''
+        for _, block in rows:
+            for row in matrix_json((), (), block)["distances"]:
+                output.write(separator + json.dumps(row))
+                separator = ','
+        output.write(']}\n')
@@ -0,0 +1,150 @@
+import threading
+import time
+from contextlib import nullcontext
+from django.conf import settings
+
+# Upper bounds, in seconds, of the stage duration histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0)
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_disabled = nullcontext()
+
+
+class Stage:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.started)
+
+
+def stage(name):
+    """Context manager timing a stage; a shared no-op unless
+    ``ROUTING_METRICS_ENABLED`` is set."""
+    if not settings.ROUTING_METRICS_ENABLED:
+        return _disabled
+    return Stage(name)
+
+
+def start():
+    """Start time for ``record_search``, or None when metrics are off."""
+    if not settings.ROUTING_METRICS_ENABLED:
+        return None
+    return time.perf_counter()
+
+
+def record_search(name, started, **counts):
+    """Record a search that began at ``started`` (from ``start()``), with
+    event counts such as heap pops and settled steps."""
+    if started is None:
+        return
+    with _lock:
+        for event, count in counts.items():
+            key = (name, event)
+            _counters[key] = _counters.get(key, 0) + count
+    observe(name, time.perf_counter() - started,
+            ' '.join(f"{event}={count}" for event, count in counts.items()))
+
+
+def observe(name, seconds, description=None):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = [[0] * len(BUCKETS), 0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings.append((name, seconds, description))
+
+
+def start_collecting():
+    """Collect this thread's stage timings until ``stop_collecting``."""
+    _local.timings = [] if settings.ROUTING_METRICS_ENABLED else None
+
+
+def stop_collecting():
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    return timings
+
+
+def server_timing(timings):
+    entries = []
+    for name, seconds, description in timings:
+        entry = f"{name};dur={seconds * 1000.0:.3f}"
+        if description:
+            entry += f';desc="{description}"'
+        entries.append(entry)
+    return ', '.join(entries)
+
+
+class ServerTimingMixin:
+    """Adds a Server-Timing header with the stages timed while the view
+    ran, plus the whole view as ``view``."""
+
+    def initial(self, request, *args, **kwargs):
+        start_collecting()
+        self._view_started = time.perf_counter()
+        super().initial(request, *args, **kwargs)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args,
+                                             **kwargs)
+        timings = stop_collecting()
+        if timings is not None:
+            observe('view', time.perf_counter() - self._view_started)
+            timings.append(('view',
+                            time.perf_counter() - self._view_started, None))
+            response['Server-Timing'] = server_timing(timings)
+        return response
+
+
+def prometheus_text(counters=()):
+    """Metrics in the Prometheus text exposition format. ``counters`` adds
+    ``(name, help, value)`` counters."""
+    with _lock:
+        histograms = {name: (list(buckets), total, count)
+                      for name, (buckets, total, count)
+                      in _histograms.items()}
+        events = dict(_counters)
+    lines = [
+        "# HELP routecalc_stage_duration_seconds Time spent in each "
+        "routing stage.",
+        "# TYPE routecalc_stage_duration_seconds histogram",
+    ]
+    for name, (buckets, total, count) in sorted(histograms.items()):
+        for bound, observed in zip(BUCKETS, buckets):
+            lines.append(f'routecalc_stage_duration_seconds_bucket'
+                         f'{{stage="{name}",le="{bound}"}} {observed}')
+        lines.append(f'routecalc_stage_duration_seconds_bucket'
+                     f'{{stage="{name}",le="+Inf"}} {count}')
+        lines.append(f'routecalc_stage_duration_seconds_sum'
+                     f'{{stage="{name}"}} {total}')
+        lines.append(f'routecalc_stage_duration_seconds_count'
+                     f'{{stage="{name}"}} {count}')
+    lines += [
+        "# HELP routecalc_search_events_total Heap pops, settled steps and "
+        "other events counted by the route searches.",
+        "# TYPE routecalc_search_events_total counter",
+    ]
+    for (name, event), count in sorted(events.items()):
+        lines.append(f'routecalc_search_events_total'
+                     f'{{search="{name}",event="{event}"}} {count}')
+    for name, help_text, value in counters:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter",
+                  f"{name} {value}"]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.8 on 2026-10-16 10:12
+
+from django.db import migrations, models
+
+
+def project_existing_points(apps, schema_editor):
+    from routecalc.models import project_coordinates
+    Point = apps.get_model('routecalc', 'Point')
+    points = list(Point.objects.only('id', 'x_coord', 'y_coord'))
+    if not points:
+        return
+    xs, ys = project_coordinates([p.x_coord for p in points],
+                                 [p.y_coord for p in points])
+    for point, x_utm, y_utm in zip(points, xs.tolist(), ys.tolist()):
+        point.x_utm = x_utm
+        point.y_utm = y_utm
+    Point.objects.bulk_update(points, ['x_utm', 'y_utm'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routecalc', '0005_line_color'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='point',
+            name='x_utm',
+            field=models.FloatField(editable=False, null=True, verbose_name='Coordenada X (UTM)'),
+        ),
+        migrations.AddField(
+            model_name='point',
+            name='y_utm',
+            field=models.FloatField(editable=False, null=True, verbose_name='Coordenada Y (UTM)'),
+        ),
+        migrations.RunPython(project_existing_points,
+                             migrations.RunPython.noop),
+    ]
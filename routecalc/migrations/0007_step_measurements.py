@@ -0,0 +1,50 @@
+# Generated by Django 5.2.8 on 2026-10-16 11:40
+
+import numpy
+from django.db import migrations, models
+
+
+def measure_existing_routes(apps, schema_editor):
+    from routecalc.models import measure_chains, project_coordinates
+    Route = apps.get_model('routecalc', 'Route')
+    Step = apps.get_model('routecalc', 'Step')
+    steps = list(Step.objects.select_related('point').order_by('id'))
+    if not steps:
+        return
+    xs, ys = project_coordinates([s.point.x_coord for s in steps],
+                                 [s.point.y_coord for s in steps])
+    segment, cumulative, _ = measure_chains(
+        Route.objects.values_list('first_id', flat=True),
+        [s.id for s in steps],
+        [-1 if s.next_id is None else s.next_id for s in steps],
+        numpy.column_stack((xs, ys))
+    )
+    for step, length, distance in zip(steps, segment.tolist(),
+                                      cumulative.tolist()):
+        step.segment_length = length
+        step.cumulative_distance = (None if numpy.isnan(distance)
+                                    else distance)
+    Step.objects.bulk_update(
+        steps, ['segment_length', 'cumulative_distance'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routecalc', '0006_point_utm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='step',
+            name='segment_length',
+            field=models.FloatField(editable=False, null=True, verbose_name='Longitud del tramo'),
+        ),
+        migrations.AddField(
+            model_name='step',
+            name='cumulative_distance',
+            field=models.FloatField(editable=False, null=True, verbose_name='Distancia acumulada'),
+        ),
+        migrations.RunPython(measure_existing_routes,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.8 on 2026-10-16 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routecalc', '0007_step_measurements'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NetworkVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0, verbose_name='Versión')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Actualizado')),
+            ],
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.8 on 2026-10-16 15:22
+
+from django.db import migrations, models
+
+
+def number_existing_steps(apps, schema_editor):
+    from routecalc.models import order_chains
+    Route = apps.get_model('routecalc', 'Route')
+    Step = apps.get_model('routecalc', 'Step')
+    steps = list(Step.objects.only('id', 'next_id').order_by('id'))
+    if not steps:
+        return
+    chains = order_chains(
+        Route.objects.values_list('first_id', flat=True),
+        [s.id for s in steps],
+        [-1 if s.next_id is None else s.next_id for s in steps]
+    )
+    for order in chains.values():
+        for position, index in enumerate(order.tolist()):
+            steps[index].sequence = position
+    Step.objects.bulk_update(steps, ['sequence'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routecalc', '0008_networkversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='step',
+            name='sequence',
+            field=models.PositiveIntegerField(editable=False, null=True, verbose_name='Orden'),
+        ),
+        migrations.RunPython(number_existing_steps,
+                             migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+from django.db import migrations
+
+
+def create_version_row(apps, schema_editor):
+    NetworkVersion = apps.get_model('routecalc', 'NetworkVersion')
+    NetworkVersion.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routecalc', '0009_step_sequence'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_version_row,
+                             migrations.RunPython.noop),
+    ]
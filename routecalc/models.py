@@ -1,4 +1,5 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
 import numpy
 from pyproj import Transformer
 
@@ -6,6 +7,23 @@ GLOBAL_TRANSFORMER = Transformer.from_crs("EPSG:4326", "EPSG:32720",
                                           always_xy=True)
 
 
+def project_coordinates(x_coords, y_coords):
+    projected_x, projected_y = GLOBAL_TRANSFORMER.transform(
+        numpy.asarray(x_coords, dtype=float),
+        numpy.asarray(y_coords, dtype=float)
+    )
+    return numpy.asarray(projected_x), numpy.asarray(projected_y)
+
+
+def unproject_coordinates(projected_x, projected_y):
+    x_coords, y_coords = GLOBAL_TRANSFORMER.transform(
+        numpy.asarray(projected_x, dtype=float),
+        numpy.asarray(projected_y, dtype=float),
+        direction='INVERSE'
+    )
+    return numpy.asarray(x_coords), numpy.asarray(y_coords)
+
+
 class Line(models.Model):
     name = models.CharField("Nombre", max_length=5)
     color = models.CharField(max_length=10)
@@ -14,17 +32,174 @@ class Line(models.Model):
         return self.name
 
 
+class PointQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        # Points projected by the caller keep their coordinates.
+        project_points([point for point in objs
+                        if point.x_utm is None or point.y_utm is None])
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def projected(self, raw=False):
+        """Return ``(ids, coords)`` with coords as an (n, 2) array in metres.
+
+        Rows whose cached projection is missing are projected in one batch.
+        With ``raw`` the stored ``(x_coord, y_coord)`` pairs are returned as
+        a third array.
+        """
+        rows = numpy.array(
+            self.order_by('id').values_list(
+                'id', 'x_coord', 'y_coord', 'x_utm', 'y_utm'),
+            dtype=float
+        ).reshape(-1, 5)
+        missing = numpy.isnan(rows[:, 3]) | numpy.isnan(rows[:, 4])
+        if missing.any():
+            rows[missing, 3], rows[missing, 4] = project_coordinates(
+                rows[missing, 1], rows[missing, 2])
+        if raw:
+            return rows[:, 0].astype(numpy.int64), rows[:, 3:5], rows[:, 1:3]
+        return rows[:, 0].astype(numpy.int64), rows[:, 3:5]
+
+
 class Point(models.Model):
     x_coord = models.FloatField("Coordenada X")
     y_coord = models.FloatField("Coordenada Y")
+    x_utm = models.FloatField("Coordenada X (UTM)", null=True,
+                              editable=False)
+    y_utm = models.FloatField("Coordenada Y (UTM)", null=True,
+                              editable=False)
+
+    objects = PointQuerySet.as_manager()
 
     def __str__(self):
         return f"({self.x_coord}, {self.y_coord})"
 
     def __array__(self) -> numpy.ndarray:
-        transformer = GLOBAL_TRANSFORMER
-        x_coord, y_coord = transformer.transform(self.x_coord, self.y_coord)
-        return numpy.array([x_coord, y_coord], dtype=float)
+        if self.x_utm is None or self.y_utm is None:
+            self.project()
+        return numpy.array([self.x_utm, self.y_utm], dtype=float)
+
+    def project(self):
+        self.x_utm, self.y_utm = GLOBAL_TRANSFORMER.transform(self.x_coord,
+                                                              self.y_coord)
+
+    def save(self, *args, **kwargs):
+        self.project()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'x_utm', 'y_utm'}
+        super().save(*args, **kwargs)
+
+
+def project_points(points):
+    """Fill the cached UTM coordinates of many points in one transform."""
+    if not points:
+        return
+    xs, ys = project_coordinates([p.x_coord for p in points],
+                                 [p.y_coord for p in points])
+    for point, x_utm, y_utm in zip(points, xs.tolist(), ys.tolist()):
+        point.x_utm = x_utm
+        point.y_utm = y_utm
+
+
+def order_chains(first_ids, step_ids, next_ids):
+    """Walk each route's ``next`` chain from its first step.
+
+    ``step_ids`` must be sorted and ``next_ids`` (-1 for the last step)
+    aligned with it. Returns ``{first_id: positions}`` with the positions in
+    ``step_ids`` of each chain's steps, in riding order.
+    """
+    step_ids = numpy.asarray(step_ids, dtype=numpy.int64)
+    next_of = dict(zip(step_ids.tolist(),
+                       numpy.asarray(next_ids, dtype=numpy.int64).tolist()))
+    chains = {}
+    for first_id in first_ids:
+        chain = []
+        seen = set()
+        current = first_id
+        while current >= 0 and current in next_of and current not in seen:
+            seen.add(current)
+            chain.append(current)
+            current = next_of[current]
+        if chain:
+            chains[first_id] = numpy.searchsorted(step_ids, chain)
+    return chains
+
+
+def chain_sequence(first_ids, step_ids, next_ids):
+    """Position of each step in its route's ``next`` chain, aligned with the
+    sorted ``step_ids``; -1 for steps no chain reaches."""
+    sequence = numpy.full(len(step_ids), -1, dtype=numpy.int64)
+    for order in order_chains(first_ids, step_ids, next_ids).values():
+        sequence[order] = numpy.arange(len(order))
+    return sequence
+
+
+def measure_chains(first_ids, step_ids, next_ids, coords):
+    """Measure every route along its ``next`` chain in one vectorized pass.
+
+    ``step_ids`` must be sorted; ``next_ids`` (-1 for the last step) and
+    ``coords`` are aligned with it. Returns per-step segment lengths and
+    cumulative distances from the route's first step, plus the total length
+    of each chain keyed by its first step id.
+    """
+    step_ids = numpy.asarray(step_ids, dtype=numpy.int64)
+    next_ids = numpy.asarray(next_ids, dtype=numpy.int64)
+    segment = numpy.zeros(len(step_ids), dtype=float)
+    cumulative = numpy.full(len(step_ids), numpy.nan, dtype=float)
+    has_next = next_ids >= 0
+    next_index = numpy.searchsorted(step_ids, next_ids[has_next])
+    segment[has_next] = numpy.linalg.norm(
+        coords[next_index] - coords[has_next], axis=1)
+    totals = {}
+    for first_id, order in order_chains(first_ids, step_ids,
+                                        next_ids).items():
+        cumulative[order[0]] = 0.0
+        cumulative[order[1:]] = numpy.cumsum(segment[order[:-1]])
+        totals[first_id] = float(segment[order].sum())
+    return segment, cumulative, totals
+
+
+class RouteQuerySet(models.QuerySet):
+    def measure(self):
+        """Store sequence numbers, segment lengths and cumulative distances
+        on the Steps of these routes.
+
+        Returns ``{route_id: length_m}`` with the geometric length of each
+        route so it can be checked against ``Route.distance``.
+        """
+        routes = dict(self.values_list('first_id', 'id'))
+        rows = numpy.array(
+            Step.objects.filter(route_id__in=routes.values())
+            .order_by('id').values_list('id', 'next_id', 'point_id'),
+            dtype=float
+        ).reshape(-1, 3)
+        if not len(rows):
+            return {}
+        step_ids = rows[:, 0].astype(numpy.int64)
+        next_ids = numpy.nan_to_num(rows[:, 1], nan=-1).astype(numpy.int64)
+        # A route being built step by step can point at a step not written
+        # yet; its chain ends there for now.
+        next_ids[~numpy.isin(next_ids, step_ids)] = -1
+        point_ids, point_coords = Point.objects.filter(
+            id__in=numpy.unique(rows[:, 2]).astype(numpy.int64).tolist()
+        ).projected()
+        coords = point_coords[numpy.searchsorted(point_ids, rows[:, 2])]
+        segment, cumulative, totals = measure_chains(
+            routes.keys(), step_ids, next_ids, coords)
+        sequence = chain_sequence(routes.keys(), step_ids, next_ids)
+        Step.objects.bulk_update(
+            [Step(id=step_id, segment_length=length,
+                  cumulative_distance=(None if numpy.isnan(distance)
+                                       else distance),
+                  sequence=None if position < 0 else position)
+             for step_id, length, distance, position in zip(
+                 step_ids.tolist(), segment.tolist(), cumulative.tolist(),
+                 sequence.tolist())],
+            ['segment_length', 'cumulative_distance', 'sequence'],
+            batch_size=1000
+        )
+        return {routes[first_id]: total for first_id, total in totals.items()}
 
 
 class Route(models.Model):
@@ -42,6 +217,8 @@ class Route(models.Model):
         related_name='routes'
     )
 
+    objects = RouteQuerySet.as_manager()
+
 
 class Step(models.Model):
     route = models.ForeignKey(
@@ -60,6 +237,12 @@ class Step(models.Model):
         blank=True,
         null=True
     )
+    segment_length = models.FloatField("Longitud del tramo", null=True,
+                                       editable=False)
+    cumulative_distance = models.FloatField("Distancia acumulada",
+                                            null=True, editable=False)
+    sequence = models.PositiveIntegerField("Orden", null=True,
+                                           editable=False)
 
     def __str__(self):
         res = f"{self.point.__str__()} -> "
@@ -67,9 +250,39 @@ class Step(models.Model):
         return res
 
     def distance_to_next_step(self):
-        if self.next is None:
+        if self.next_id is None:
             return 0.0
+        if self.segment_length is not None:
+            return self.segment_length
         p1_coords = self.point.__array__()
         p2_coords = self.next.point.__array__()
         distance = numpy.linalg.norm(p2_coords - p1_coords)
         return float(distance)
+
+
+class NetworkVersion(models.Model):
+    version = models.PositiveBigIntegerField("Versión", default=0)
+    updated_at = models.DateTimeField("Actualizado", auto_now=True)
+
+    @classmethod
+    def current(cls):
+        row = cls.objects.filter(pk=1).values_list('version', flat=True)
+        return row[0] if row else 0
+
+    @classmethod
+    def bump(cls):
+        # The row is created by migration 0010; it is only missing from
+        # databases flushed since, where two first writers may race to
+        # create it.
+        if cls._increment():
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(pk=1, version=1)
+        except IntegrityError:
+            cls._increment()
+
+    @classmethod
+    def _increment(cls):
+        return cls.objects.filter(pk=1).update(
+            version=models.F('version') + 1, updated_at=timezone.now())
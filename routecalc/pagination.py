@@ -0,0 +1,15 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class NetworkCursorPagination(CursorPagination):
+    """Pages through a network table by id. ``?page_size=`` picks the page
+    size, up to ``ROUTING_MAX_PAGE_SIZE``."""
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        # Read on every request so the settings can be overridden.
+        self.page_size = settings.ROUTING_PAGE_SIZE
+        self.max_page_size = settings.ROUTING_MAX_PAGE_SIZE
+        return super().get_page_size(request)
@@ -0,0 +1,34 @@
+import io
+import json
+import numpy as np
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+class NpyRenderer(BaseRenderer):
+    """Renders a numpy array as a ``.npy`` file."""
+    media_type = 'application/x-npy'
+    format = 'npy'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        buffer = io.BytesIO()
+        np.save(buffer, data, allow_pickle=False)
+        return buffer.getvalue()
+
+
+class RenderedJSON(bytes):
+    """A response body already encoded as JSON."""
+
+
+class PrerenderedJSONRenderer(JSONRenderer):
+    """JSONRenderer that passes ``RenderedJSON`` bodies through as they
+    are, unless indentation is asked for."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, RenderedJSON):
+            if self.get_indent(accepted_media_type,
+                               renderer_context or {}) is None:
+                return bytes(data)
+            data = json.loads(data)
+        return super().render(data, accepted_media_type, renderer_context)
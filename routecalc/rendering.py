@@ -0,0 +1,141 @@
+import json
+import math
+import numpy as np
+from .encoding import encode_coordinates
+from .models import Line, Route
+from .serializers import RouteSerializer
+from .versioning import DerivedStructure
+
+
+def encode_json(data):
+    """``data`` as the text DRF's JSONRenderer produces with its default
+    settings: compact separators, unescaped unicode, no NaN."""
+    return json.dumps(data, ensure_ascii=False, allow_nan=False,
+                      separators=(',', ':')).replace(
+        '\u2028', '\\u2028').replace('\u2029', '\\u2029')
+
+
+def encode_float(value):
+    # The json module writes floats with float.__repr__.
+    if not math.isfinite(value):
+        raise ValueError("Out of range float values are not JSON compliant")
+    return float.__repr__(value)
+
+
+def encode_point(x_coord, y_coord):
+    """A PointSerializer item."""
+    return '{"x_coord":%s,"y_coord":%s}' % (encode_float(x_coord),
+                                            encode_float(y_coord))
+
+
+def encode_path(coords, geometry_format, precision):
+    if geometry_format == 'points':
+        return '[%s]' % ','.join(encode_point(x, y) for x, y in coords)
+    return encode_json(encode_coordinates(coords, geometry_format, precision))
+
+
+WALKING_ORIGIN = encode_json(RouteSerializer(Route(
+    id=999, line=Line(id=998, name="L000", color="#000000"),
+    isReturn=False, distance=0, time=0)).data)
+WALKING_DESTINATION = encode_json(RouteSerializer(Route(
+    id=1001, line=Line(id=1000, name="L000", color="#000000"),
+    isReturn=False, distance=0, time=0)).data)
+
+
+class RouteMetadata(DerivedStructure):
+    """RouteSerializer output of every route, encoded once per network
+    version."""
+    snapshot_fields = ('route_ids', 'route_json')
+
+    def _build(self):
+        routes = list(Route.objects.select_related('line').order_by('id'))
+        self.route_ids = np.array([route.id for route in routes],
+                                  dtype=np.int64)
+        self.route_json = np.array(
+            [encode_json(data)
+             for data in RouteSerializer(routes, many=True).data] or [''])
+        self._restore()
+
+    def _restore(self):
+        self._encoded = dict(zip(self.route_ids.tolist(),
+                                 self.route_json.tolist()))
+
+    def encoded(self, route_id):
+        if route_id not in self._encoded:
+            # Created after this instance was built.
+            self._encoded[route_id] = encode_json(RouteSerializer(
+                Route.objects.select_related('line').get(id=route_id)).data)
+        return self._encoded[route_id]
+
+
+class RiddenPath:
+    """The part of a best-route answer that does not depend on where
+    exactly the origin and destination are: the ride segments, rendered
+    once per geometry format, and the distance between the first and last
+    stop.
+
+    Built straight from a ``search_paths`` result, so rendering needs
+    neither model instances nor serializers.
+    """
+
+    def __init__(self, graph, path, distance, start_costs, end_costs):
+        points = [graph._point[step] for step in path]
+        self.start_id = int(graph.point_ids[points[0]])
+        self.end_id = int(graph.point_ids[points[-1]])
+        self.start_cost = start_costs.get(self.start_id, 0.0)
+        self.end_cost = end_costs.get(self.end_id, 0.0)
+        self.distance = distance
+        coords = graph.point_xy[points].tolist()
+        self.first_point = coords[0]
+        self.last_point = coords[-1]
+        self.segments = []
+        current = None
+        for step, point_xy in zip(path, coords):
+            if graph._route[step] != current:
+                current = graph._route[step]
+                self.segments.append((int(graph.route_ids[current]), []))
+            self.segments[-1][1].append(point_xy)
+        # The last segment repeats the final stop.
+        self.segments[-1][1].append(self.last_point)
+        self._rendered = {}
+
+    def segments_json(self, geometry_format, precision):
+        key = (geometry_format, precision)
+        if key not in self._rendered:
+            metadata = RouteMetadata()
+            self._rendered[key] = ','.join(
+                '{"route":%s,"path":%s}' % (
+                    metadata.encoded(route_id),
+                    encode_path(coords, geometry_format, precision))
+                for route_id, coords in self.segments)
+        return self._rendered[key]
+
+    def render(self, start_costs, end_costs, o_x, o_y, d_x, d_y,
+               geometry_format='points', precision=5):
+        start_cost = start_costs.get(self.start_id, 0.0)
+        end_cost = end_costs.get(self.end_id, 0.0)
+        distance = self.distance
+        if (start_cost, end_cost) != (self.start_cost, self.end_cost):
+            distance = (start_cost +
+                        (distance - self.start_cost - self.end_cost) +
+                        end_cost)
+        return '{"distance":%s,"segments":[%s,%s,%s]}' % (
+            encode_float(distance),
+            '{"route":%s,"path":%s}' % (
+                WALKING_ORIGIN,
+                encode_path([(o_x, o_y), self.first_point],
+                            geometry_format, precision)),
+            self.segments_json(geometry_format, precision),
+            '{"route":%s,"path":%s}' % (
+                WALKING_DESTINATION,
+                encode_path([self.last_point, (d_x, d_y)],
+                            geometry_format, precision)))
+
+
+def render_paths(ridden, start_costs, end_costs, o_x, o_y, d_x, d_y,
+                 geometry_format='points', precision=5):
+    """The BestRoutesView body for ``ridden`` paths, as UTF-8 JSON."""
+    return ('[%s]' % ','.join(
+        path.render(start_costs, end_costs, o_x, o_y, d_x, d_y,
+                    geometry_format, precision)
+        for path in ridden)).encode()
@@ -0,0 +1,505 @@
+import heapq
+import threading
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from .graph import TransitGraph
+from .models import Point, Route, Step
+from . import metrics
+
+INF_COST = (float('inf'), float('inf'))
+
+
+def reconstruct_path(end_step, predecessors):
+    path = []
+    current = end_step
+    while current is not None:
+        path.append(current)
+        current = predecessors.get(current)
+    path.reverse()
+    return path
+
+
+def transfers(graph, step, switch_cost, walking_multiplier):
+    point = graph._point[step]
+    for switch_neighbor in graph.steps_at(point):
+        if switch_neighbor != step:
+            yield switch_neighbor, switch_cost
+    for nearby_point, walk_length in graph.walks_from(point):
+        walk_cost = switch_cost + walk_length * walking_multiplier
+        for switch_neighbor in graph.steps_at(nearby_point):
+            yield switch_neighbor, walk_cost
+
+
+def edges_after(graph, step, switch_cost, walking_multiplier):
+    neighbor = graph._next[step]
+    if neighbor >= 0:
+        yield neighbor, graph._weight[step]
+    for switch_neighbor, cost in transfers(graph, step, switch_cost,
+                                           walking_multiplier):
+        if switch_neighbor != neighbor:
+            yield switch_neighbor, cost
+
+
+def edges_before(graph, step, switch_cost, walking_multiplier):
+    for previous in graph.steps_before(step):
+        yield previous, graph._weight[previous]
+    yield from transfers(graph, step, switch_cost, walking_multiplier)
+
+
+class RemainingBounds(dict):
+    """Lazily computed lower bound, per point, on the cost left to arrive.
+
+    Riding between two stops costs their straight-line distance, walking
+    costs that distance times the walking multiplier and transfers never
+    cost less than zero, so the distance to the nearest end point (scaled
+    down if walking is cheaper than riding) plus its walking cost is
+    admissible and consistent.
+    """
+
+    def __init__(self, graph, end_costs, walking_multiplier=1.0):
+        super().__init__()
+        self.scale = min(1.0, walking_multiplier)
+        self.coords = graph.point_coords
+        self.end_coords = graph.point_coords[list(end_costs)]
+        self.walk_costs = numpy.fromiter(end_costs.values(), dtype=float,
+                                         count=len(end_costs))
+
+    def __missing__(self, point):
+        bound = float((numpy.linalg.norm(
+            self.end_coords - self.coords[point], axis=1) * self.scale +
+            self.walk_costs).min())
+        self[point] = bound
+        return bound
+
+
+SEARCH_MODES = ('dijkstra', 'astar', 'bidirectional')
+
+
+def find_best_path(graph, start_steps, end_costs, switch_cost, start_costs,
+                   mode='dijkstra', walking_multiplier=1.0):
+    if mode == 'bidirectional':
+        return find_best_path_bidirectional(graph, start_steps, end_costs,
+                                            switch_cost, start_costs,
+                                            walking_multiplier)
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode}")
+    started = metrics.start()
+    stale = 0
+    step_next = graph._next
+    step_point = graph._point
+    weights = graph._weight
+    bounds = None
+    if mode == 'astar':
+        bounds = RemainingBounds(graph, end_costs, walking_multiplier)
+    pq = []
+    distances = {}
+    predecessors = {}
+    entry_count = 0
+    best_result = (None, float('inf'), None, None)
+    for step in start_steps:
+        walk_cost = start_costs.get(step_point[step], 0.0)
+        distances[step] = (walk_cost, 0)
+        key = walk_cost
+        if bounds is not None:
+            key += bounds[step_point[step]]
+        heapq.heappush(pq, (key, 0, entry_count, step, walk_cost))
+        entry_count += 1
+    while pq:
+        key, current_switches, _, current_step, current_dist = heapq.heappop(
+            pq)
+        if key >= best_result[1]:
+            break
+        known_dist, known_switches = distances[current_step]
+        if (current_dist > known_dist and
+                current_switches > known_switches):
+            stale += 1
+            continue
+        point = step_point[current_step]
+        if point in end_costs:
+            total_dist = current_dist + end_costs[point]
+            if total_dist < best_result[1]:
+                path = reconstruct_path(current_step, predecessors)
+                best_result = (path, total_dist, step_point[path[0]], point)
+        neighbor = step_next[current_step]
+        if neighbor >= 0:
+            new_cost = (current_dist + weights[current_step],
+                        current_switches)
+            if new_cost < distances.get(neighbor, INF_COST):
+                distances[neighbor] = new_cost
+                predecessors[neighbor] = current_step
+                key = new_cost[0]
+                if bounds is not None:
+                    key += bounds[step_point[neighbor]]
+                heapq.heappush(pq, (key, new_cost[1], entry_count, neighbor,
+                                    new_cost[0]))
+                entry_count += 1
+        for switch_neighbor, cost in transfers(graph, current_step,
+                                               switch_cost,
+                                               walking_multiplier):
+            new_cost = (current_dist + cost, current_switches + 1)
+            if new_cost < distances.get(switch_neighbor, INF_COST):
+                distances[switch_neighbor] = new_cost
+                predecessors[switch_neighbor] = current_step
+                key = new_cost[0]
+                if bounds is not None:
+                    key += bounds[step_point[switch_neighbor]]
+                heapq.heappush(pq, (key, new_cost[1], entry_count,
+                                    switch_neighbor, new_cost[0]))
+                entry_count += 1
+    pops = entry_count - len(pq)
+    metrics.record_search(f"search-{mode}", started, pops=pops,
+                          settled=pops - stale)
+    return best_result
+
+
+def find_best_path_bidirectional(graph, start_steps, end_costs, switch_cost,
+                                 start_costs, walking_multiplier=1.0):
+    started = metrics.start()
+    stale = 0
+    step_point = graph._point
+    costs = ({}, {})
+    parents = ({}, {})
+    queues = ([], [])
+    settled = (set(), set())
+    edges = (edges_after, edges_before)
+    for step in start_steps:
+        walk_cost = start_costs.get(step_point[step], 0.0)
+        if walk_cost < costs[0].get(step, float('inf')):
+            costs[0][step] = walk_cost
+            parents[0][step] = None
+            heapq.heappush(queues[0], (walk_cost, step))
+    for point, walk_cost in end_costs.items():
+        for step in graph.steps_at(point):
+            costs[1][step] = walk_cost
+            parents[1][step] = None
+            heapq.heappush(queues[1], (walk_cost, step))
+    best, meeting = float('inf'), None
+    for step, cost in costs[0].items():
+        if step in costs[1] and cost + costs[1][step] < best:
+            best, meeting = cost + costs[1][step], step
+    # Both searches start from a virtual terminal, so the classic criterion
+    # applies unchanged: stop once the two queue heads cannot beat ``best``.
+    while queues[0] and queues[1]:
+        if queues[0][0][0] + queues[1][0][0] >= best:
+            break
+        side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+        other = 1 - side
+        cost, step = heapq.heappop(queues[side])
+        if step in settled[side] or cost > costs[side][step]:
+            stale += 1
+            continue
+        settled[side].add(step)
+        for neighbor, weight in edges[side](graph, step, switch_cost,
+                                            walking_multiplier):
+            new_cost = cost + weight
+            if new_cost < costs[side].get(neighbor, float('inf')):
+                costs[side][neighbor] = new_cost
+                parents[side][neighbor] = step
+                heapq.heappush(queues[side], (new_cost, neighbor))
+                if (neighbor in costs[other] and
+                        new_cost + costs[other][neighbor] < best):
+                    best = new_cost + costs[other][neighbor]
+                    meeting = neighbor
+    settled_count = len(settled[0]) + len(settled[1])
+    metrics.record_search("search-bidirectional", started,
+                          pops=settled_count + stale, settled=settled_count)
+    if meeting is None:
+        return (None, float('inf'), None, None)
+    path = reconstruct_path(meeting, parents[0])
+    current = parents[1][meeting]
+    while current is not None:
+        path.append(current)
+        current = parents[1][current]
+    return (path, best, step_point[path[0]], step_point[path[-1]])
+
+
+def reachable_points(graph, start_costs, budget, switch_cost,
+                     walking_multiplier=1.0):
+    """Cheapest cost of every point reachable within ``budget``.
+
+    ``start_costs`` maps point indices to the cost of walking there from
+    the origin. One Dijkstra over the steps, with the same ride and
+    transfer edges as ``find_best_path``, stops expanding at the budget.
+    """
+    started = metrics.start()
+    stale = 0
+    reached = {}
+    costs = {}
+    pq = []
+    for point, walk_cost in start_costs.items():
+        if walk_cost > budget:
+            continue
+        reached[point] = min(walk_cost, reached.get(point, float('inf')))
+        for step in graph.steps_at(point):
+            if walk_cost < costs.get(step, float('inf')):
+                costs[step] = walk_cost
+                heapq.heappush(pq, (walk_cost, step))
+    settled = set()
+    while pq:
+        cost, step = heapq.heappop(pq)
+        if step in settled:
+            stale += 1
+            continue
+        settled.add(step)
+        point = graph._point[step]
+        if cost < reached.get(point, float('inf')):
+            reached[point] = cost
+        for neighbor, weight in edges_after(graph, step, switch_cost,
+                                            walking_multiplier):
+            new_cost = cost + weight
+            if (new_cost <= budget and
+                    new_cost < costs.get(neighbor, float('inf'))):
+                costs[neighbor] = new_cost
+                heapq.heappush(pq, (new_cost, neighbor))
+    metrics.record_search("search-reach", started, pops=len(settled) + stale,
+                          settled=len(settled))
+    return reached
+
+
+class AlternativePaths:
+    """Alternative paths read off two shortest-path trees.
+
+    One Dijkstra runs forward from the start steps and one backwards from
+    the end steps. Every step ``v`` reachable both ways yields the via-path
+    "best way to ``v``, then best way from ``v``" of cost
+    ``forward[v] + remaining[v]``; the cheapest of these is the shortest
+    path, and the others are locally optimal alternatives. Both trees are
+    reused for every alternative, so K paths cost two searches plus one
+    tree walk per candidate.
+    """
+
+    def __init__(self, graph, start_costs, end_costs, switch_cost,
+                 walking_multiplier=1.0):
+        self.graph = graph
+        self.switch_cost = switch_cost
+        self.walking_multiplier = walking_multiplier
+        self.forward, self.predecessors = self._tree(
+            start_costs, edges_after, "search-forward")
+        self.remaining, self.successors = self._tree(
+            end_costs, edges_before, "search-reverse")
+
+    def _tree(self, seed_costs, edges, name):
+        started = metrics.start()
+        stale = 0
+        costs = {}
+        parents = {}
+        pq = []
+        for point, walk_cost in seed_costs.items():
+            for step in self.graph.steps_at(point):
+                if walk_cost < costs.get(step, float('inf')):
+                    costs[step] = walk_cost
+                    parents[step] = None
+                    heapq.heappush(pq, (walk_cost, step))
+        settled = set()
+        while pq:
+            cost, step = heapq.heappop(pq)
+            if step in settled:
+                stale += 1
+                continue
+            settled.add(step)
+            for neighbor, weight in edges(self.graph, step, self.switch_cost,
+                                          self.walking_multiplier):
+                new_cost = cost + weight
+                if new_cost < costs.get(neighbor, float('inf')):
+                    costs[neighbor] = new_cost
+                    parents[neighbor] = step
+                    heapq.heappush(pq, (new_cost, neighbor))
+        metrics.record_search(name, started, pops=len(settled) + stale,
+                              settled=len(settled))
+        return costs, parents
+
+    def via_path(self, step):
+        path = reconstruct_path(step, self.predecessors)
+        current = self.successors[step]
+        while current is not None:
+            path.append(current)
+            current = self.successors[current]
+        return path
+
+    def paths(self, count, accept=None, max_candidates=None):
+        """Return up to ``count`` loopless ``(steps, cost)``, cheapest first.
+
+        ``accept`` may refuse a path (e.g. one too similar to those already
+        returned); at most ``max_candidates`` paths are examined in total.
+        """
+        started = metrics.start()
+        remaining = self.remaining
+        via_costs = sorted((cost + remaining[step], step)
+                           for step, cost in self.forward.items()
+                           if step in remaining)
+        covered = set()
+        accepted = []
+        examined = 0
+        for cost, step in via_costs:
+            if len(accepted) >= count:
+                break
+            if max_candidates is not None and examined >= max_candidates:
+                break
+            if step in covered:
+                continue
+            examined += 1
+            path = self.via_path(step)
+            covered.update(path)
+            if len(set(path)) != len(path):
+                continue
+            if accept is None or accept(path):
+                accepted.append((path, cost))
+        metrics.record_search("search-candidates", started,
+                              examined=examined, accepted=len(accepted))
+        return accepted
+
+
+def ridden_routes(graph, path):
+    riding = {}
+    for step, neighbor in zip(path, path[1:]):
+        if graph._next[step] == neighbor:
+            route = graph._route[step]
+            riding[route] = riding.get(route, 0.0) + graph._weight[step]
+    return riding
+
+
+def shared_route_fraction(riding, accepted_routes):
+    total = sum(riding.values())
+    if total <= 0:
+        return 1.0
+    shared = sum(length for route, length in riding.items()
+                 if route in accepted_routes)
+    return shared / total
+
+
+def path_distance(graph, path):
+    step_next = graph._next
+    step_point = graph._point
+    cumulative = graph._cumulative
+    distance = 0.0
+    run_start = path[0]
+    for previous, step in zip(path, path[1:]):
+        if step_next[previous] != step:
+            distance += cumulative[previous] - cumulative[run_start]
+            if step_point[previous] != step_point[step]:
+                distance += float(numpy.linalg.norm(
+                    graph.point_coords[step_point[step]] -
+                    graph.point_coords[step_point[previous]]))
+            run_start = step
+    return distance + cumulative[path[-1]] - cumulative[run_start]
+
+
+def materialize_paths(graph, k_results):
+    point_ids = {int(graph.point_ids[graph._point[s]])
+                 for path, _ in k_results for s in path}
+    route_ids = {int(graph.route_ids[graph._route[s]])
+                 for path, _ in k_results for s in path}
+    points = Point.objects.in_bulk(point_ids)
+    routes = Route.objects.select_related('line').in_bulk(route_ids)
+    materialized = []
+    for path, distance in k_results:
+        steps = [Step(id=int(graph.step_ids[s]),
+                      point=points[int(graph.point_ids[graph._point[s]])],
+                      route=routes[int(graph.route_ids[graph._route[s]])])
+                 for s in path]
+        materialized.append((steps, distance))
+    return materialized
+
+
+def search_paths(
+    graph: TransitGraph,
+    start_point_ids: list[int],
+    end_point_ids: list[int],
+    start_costs: dict,
+    end_costs: dict,
+    K: int = 3,
+    switch_cost: float = 0.001,
+    walking_multiplier: float = 5.0,
+    max_shared_fraction: float = None,
+    search_mode: str = None
+) -> list[tuple[list, float]]:
+    """Up to ``K`` paths as ``(step indices, real distance)`` pairs. Only
+    reads ``graph``, so it is safe to run on worker threads.
+
+    ``search_mode`` picks the ``find_best_path`` mode used when ``K`` is 1;
+    alternatives always come from two full Dijkstra trees."""
+    if max_shared_fraction is None:
+        max_shared_fraction = settings.ROUTING_MAX_SHARED_FRACTION
+    if search_mode is None:
+        search_mode = settings.ROUTING_SEARCH_MODE
+    start_index = {graph.point_index(p): p for p in start_point_ids}
+    end_index = {graph.point_index(p): p for p in end_point_ids}
+    start_index.pop(None, None)
+    end_index.pop(None, None)
+    search_start_costs = {
+        i: start_costs.get(p, 0.0) * walking_multiplier
+        for i, p in start_index.items()}
+    search_end_costs = {
+        i: end_costs.get(p, 0.0) * walking_multiplier
+        for i, p in end_index.items()}
+    k_results = []
+    if K == 1:
+        start_steps = [step for point in search_start_costs
+                       for step in graph.steps_at(point)]
+        path = find_best_path(graph, start_steps, search_end_costs,
+                              switch_cost, search_start_costs,
+                              search_mode, walking_multiplier)[0]
+        found = [path] if path else []
+    else:
+        engine = AlternativePaths(graph, search_start_costs, search_end_costs,
+                                  switch_cost, walking_multiplier)
+        accepted_routes = set()
+
+        def is_diverse(path):
+            riding = ridden_routes(graph, path)
+            if (accepted_routes and
+                    shared_route_fraction(riding, accepted_routes) >
+                    max_shared_fraction):
+                return False
+            accepted_routes.update(riding)
+            return True
+
+        found = [path for path, _ in engine.paths(
+            K, is_diverse, K * settings.ROUTING_CANDIDATES_PER_PATH)]
+    for path in found:
+        real_distance = (start_costs.get(start_index[graph._point[path[0]]],
+                                         0.0) +
+                         path_distance(graph, path) +
+                         end_costs.get(end_index[graph._point[path[-1]]],
+                                       0.0))
+        k_results.append((path, real_distance))
+    return k_results
+
+
+def calculatePaths(
+    start_point_ids: list[int],
+    end_point_ids: list[int],
+    start_costs: dict,
+    end_costs: dict,
+    K: int = 3,
+    switch_cost: float = 0.001,
+    walking_multiplier: float = 5.0,
+    max_shared_fraction: float = None,
+    search_mode: str = None
+) -> list[tuple[list, float]]:
+    with metrics.stage('graph'):
+        graph = TransitGraph()
+    k_results = search_paths(graph, start_point_ids, end_point_ids,
+                             start_costs, end_costs, K, switch_cost,
+                             walking_multiplier, max_shared_fraction,
+                             search_mode)
+    with metrics.stage('materialize'):
+        return materialize_paths(graph, k_results)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def search_executor():
+    """Process-wide pool of ``ROUTING_SEARCH_WORKERS`` threads for running
+    ``search_paths`` off the request thread."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.ROUTING_SEARCH_WORKERS,
+                    thread_name_prefix='routing')
+    return _executor
@@ -1,5 +1,7 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import Line, Route, Step, Point
+from .routing import SEARCH_MODES
 
 
 class PointSerializer(serializers.ModelSerializer):
@@ -44,3 +46,66 @@ class StepTraceSerializer(serializers.Serializer):
     steps = StepSerializer(many=True)
     length = serializers.FloatField()
     transfers = serializers.IntegerField()
+
+
+class BatchRoutesSerializer(serializers.Serializer):
+    # Pairs are validated one by one in the view so a bad pair only fails
+    # its own result line.
+    pairs = serializers.ListField(child=serializers.JSONField(),
+                                  allow_empty=False)
+    alternatives = serializers.IntegerField(min_value=1, default=5)
+    search = serializers.ChoiceField(choices=SEARCH_MODES, required=False)
+
+    def validate_pairs(self, pairs):
+        if len(pairs) > settings.ROUTING_BATCH_MAX_PAIRS:
+            raise serializers.ValidationError(
+                f"At most {settings.ROUTING_BATCH_MAX_PAIRS} pairs per "
+                f"request.")
+        return pairs
+
+    def validate(self, data):
+        # Alternatives are read off two full shortest-path trees, which the
+        # goal-directed modes cannot build.
+        if 'search' in data and data['alternatives'] > 1:
+            raise serializers.ValidationError(
+                {"search": "Only applies with alternatives=1."})
+        return data
+
+
+class DistanceMatrixSerializer(serializers.Serializer):
+    origins = serializers.ListField(child=serializers.IntegerField(),
+                                    allow_empty=False)
+    # Defaults to the origins, giving a square matrix.
+    destinations = serializers.ListField(child=serializers.IntegerField(),
+                                         allow_empty=False, required=False)
+
+    def validate(self, data):
+        data.setdefault('destinations', data['origins'])
+        cells = len(data['origins']) * len(data['destinations'])
+        if cells > settings.ROUTING_MATRIX_MAX_CELLS:
+            raise serializers.ValidationError(
+                f"At most {settings.ROUTING_MATRIX_MAX_CELLS} cells per "
+                f"request; use the distancematrix command for larger "
+                f"matrices.")
+        return data
+
+
+class RouteUploadSerializer(serializers.Serializer):
+    line = serializers.PrimaryKeyRelatedField(queryset=Line.objects.all())
+    isReturn = serializers.BooleanField()
+    time = serializers.FloatField(min_value=0.0, default=0.0)
+    # Stops in riding order, as [x_coord, y_coord] pairs.
+    coordinates = serializers.ListField(
+        child=serializers.ListField(child=serializers.FloatField(),
+                                    min_length=2, max_length=2),
+        min_length=2)
+    # Metres within which an existing point is reused; defaults to
+    # ROUTING_UPLOAD_SNAP_TOLERANCE.
+    snap_tolerance = serializers.FloatField(min_value=0.0, required=False)
+
+    def validate_coordinates(self, coordinates):
+        if len(coordinates) > settings.ROUTING_UPLOAD_MAX_STOPS:
+            raise serializers.ValidationError(
+                f"At most {settings.ROUTING_UPLOAD_MAX_STOPS} stops per "
+                f"route.")
+        return coordinates
@@ -0,0 +1,66 @@
+import threading
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .models import Line, Point, Route, Step
+from .versioning import bump_network_version
+
+_pending = threading.local()
+
+
+def network_changed(route_ids=()):
+    """Re-measure ``route_ids`` and bump the network version once the
+    current transaction commits (at once outside transactions).
+
+    Changes are collected per thread, so a transaction writing many rows
+    measures each route and bumps the version only once. A rolled-back
+    transaction leaves its routes to the next commit, which only measures
+    them again.
+    """
+    pending = getattr(_pending, 'route_ids', None)
+    if pending is None:
+        pending = _pending.route_ids = set()
+    pending.update(route_ids)
+    transaction.on_commit(apply_network_changes)
+
+
+def apply_network_changes():
+    route_ids = getattr(_pending, 'route_ids', None)
+    if route_ids is None:
+        # Already applied by an earlier callback of the same commit.
+        return
+    _pending.route_ids = None
+    # Routes deleted in the meantime, e.g. by the cascade that changed
+    # their steps, are no longer found and so not measured.
+    if route_ids:
+        Route.objects.filter(pk__in=route_ids).measure()
+    bump_network_version()
+
+
+@receiver(post_save, sender=Point)
+@receiver(post_delete, sender=Point)
+def point_changed(sender, instance, **kwargs):
+    if kwargs.get('raw'):
+        network_changed()
+    else:
+        network_changed(Step.objects.filter(
+            point_id=instance.id).values_list('route_id', flat=True))
+
+
+@receiver(post_save, sender=Step)
+@receiver(post_delete, sender=Step)
+def step_changed(sender, instance, **kwargs):
+    network_changed(() if kwargs.get('raw') else [instance.route_id])
+
+
+@receiver(post_save, sender=Route)
+@receiver(post_delete, sender=Route)
+def route_changed(sender, instance, **kwargs):
+    network_changed()
+
+
+@receiver(post_save, sender=Line)
+@receiver(post_delete, sender=Line)
+def line_changed(sender, instance, **kwargs):
+    # Names and colours are part of the rendered routes.
+    network_changed()
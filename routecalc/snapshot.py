@@ -0,0 +1,105 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+import numpy as np
+from django.conf import settings
+
+_meta_lock = threading.Lock()
+_meta_cache = {}
+
+
+def snapshot_path(version):
+    return Path(settings.ROUTING_SNAPSHOT_DIR) / f"v{version}"
+
+
+def _snapshot_settings(cls):
+    return {name: getattr(settings, name) for name in cls.snapshot_settings}
+
+
+def write_snapshot(instances, version):
+    """Write the snapshot arrays of ``instances``, all built from network
+    ``version``, as one directory of ``.npy`` files. The directory appears
+    atomically, replacing any earlier snapshot of the same version."""
+    root = Path(settings.ROUTING_SNAPSHOT_DIR)
+    root.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix=f".v{version}-", dir=root))
+    meta = {"version": version, "created": time.time(), "structures": {}}
+    for instance in instances:
+        cls = type(instance)
+        for field in cls.snapshot_fields:
+            np.save(staging / f"{cls.__name__}.{field}.npy",
+                    np.asarray(getattr(instance, field)),
+                    allow_pickle=False)
+        meta["structures"][cls.__name__] = {
+            "fields": list(cls.snapshot_fields),
+            "settings": _snapshot_settings(cls),
+        }
+    with open(staging / "meta.json", "w") as output:
+        json.dump(meta, output, indent=2)
+    os.chmod(staging, 0o755)
+    target = snapshot_path(version)
+    if target.exists():
+        shutil.rmtree(target)
+    staging.rename(target)
+    return target
+
+
+def prune_snapshots(keep):
+    """Delete all but the ``keep`` newest snapshot directories."""
+    root = Path(settings.ROUTING_SNAPSHOT_DIR)
+    snapshots = sorted((int(path.name[1:]), path) for path in root.glob('v*')
+                       if path.name[1:].isdigit())
+    removed = []
+    for _, path in snapshots[:max(len(snapshots) - keep, 0)]:
+        shutil.rmtree(path)
+        removed.append(path)
+    return removed
+
+
+def _read_meta(path):
+    # Cached per file: a snapshot rewritten in place is a new meta.json, with
+    # its own inode and mtime.
+    try:
+        stat = os.stat(path / "meta.json")
+    except OSError:
+        with _meta_lock:
+            _meta_cache.pop(path, None)
+        return None
+    stamp = (stat.st_ino, stat.st_mtime_ns)
+    with _meta_lock:
+        cached = _meta_cache.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    try:
+        with open(path / "meta.json") as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+    with _meta_lock:
+        _meta_cache[path] = (stamp, meta)
+    return meta
+
+
+def load_snapshot(cls, version):
+    """``{field: read-only memory-mapped array}`` for ``cls`` at network
+    ``version``, or None when there is no usable snapshot."""
+    if not settings.ROUTING_SNAPSHOT_DIR:
+        return None
+    path = snapshot_path(version)
+    meta = _read_meta(path)
+    if meta is None or meta.get("version") != version:
+        return None
+    entry = meta["structures"].get(cls.__name__)
+    if (entry is None or entry["fields"] != list(cls.snapshot_fields) or
+            entry["settings"] != _snapshot_settings(cls)):
+        return None
+    try:
+        return {field: np.load(path / f"{cls.__name__}.{field}.npy",
+                               mmap_mode='r', allow_pickle=False)
+                for field in cls.snapshot_fields}
+    except (OSError, ValueError):
+        return None
@@ -1,58 +1,184 @@
+import logging
 import numpy as np
-from scipy.spatial import KDTree
-from pyproj import Transformer
-from .models import Point
+from .models import Point, Step, project_coordinates
+from .versioning import DerivedStructure
 
+logger = logging.getLogger(__name__)
 
-class PointSpatialIndex:
-    _instance = None
-    _tree = None
+# Side, in metres, of the square cells of a PointGrid.
+GRID_CELL_SIZE = 250.0
+
+
+class PointGrid:
+    """Uniform grid over projected coordinates, kept entirely in arrays so
+    that it can be memory mapped from a snapshot and shared by every worker.
+
+    ``keys`` holds the sorted cell key of every point and ``coords`` their
+    coordinates in the same order; ``grid`` is ``[x0, y0, cell_size,
+    rows]``. The points of grid column ``c`` and rows ``r0`` to ``r1`` are
+    the contiguous run of keys ``c * rows + r0`` to ``c * rows + r1``.
+    """
+
+    def __init__(self, grid, keys, coords):
+        self.x0, self.y0, self.cell_size, rows = np.asarray(grid).tolist()
+        self.rows = int(rows)
+        self.keys = keys
+        self.coords = coords
+
+    @staticmethod
+    def arrange(coords, cell_size=GRID_CELL_SIZE):
+        """Grid ``coords``. Returns ``(grid, keys, order)``, where
+        ``coords[order]`` are the points in key order."""
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        origin = coords.min(axis=0) if len(coords) else np.zeros(2)
+        cells = np.floor((coords - origin) / cell_size).astype(np.int64)
+        rows = int(cells[:, 1].max()) + 1 if len(cells) else 1
+        keys = cells[:, 0] * rows + cells[:, 1]
+        order = np.argsort(keys, kind='stable')
+        return (np.array([origin[0], origin[1], cell_size, rows]),
+                keys[order], order)
+
+    def _cells(self, values, origin, last):
+        cells = np.clip((values - origin) / self.cell_size, -1.0, last + 1.0)
+        return np.floor(cells).astype(np.int64)
+
+    def within(self, xs, ys, radius):
+        """Points at most ``radius`` metres (one value, or one per query)
+        from each ``(xs[i], ys[i])``, as aligned arrays of query index,
+        position and distance, grouped by query."""
+        xs = np.asarray(xs, dtype=float).ravel()
+        ys = np.asarray(ys, dtype=float).ravel()
+        if not len(self.keys) or not len(xs):
+            return (np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp),
+                    np.empty(0, dtype=float))
+        radius = np.broadcast_to(np.asarray(radius, dtype=float), xs.shape)
+        columns = int(self.keys[-1]) // self.rows
+        first = np.maximum(self._cells(xs - radius, self.x0, columns), 0)
+        last = np.minimum(self._cells(xs + radius, self.x0, columns),
+                          columns)
+        low = np.maximum(self._cells(ys - radius, self.y0, self.rows), 0)
+        high = np.minimum(self._cells(ys + radius, self.y0, self.rows),
+                          self.rows - 1)
+        counts = np.where((radius >= 0) & (first <= last) & (low <= high),
+                          last - first + 1, 0)
+        # One run of keys per query and grid column it overlaps.
+        queries = np.repeat(np.arange(len(xs)), counts)
+        column_keys = (first[queries] + np.arange(len(queries)) -
+                       np.repeat(np.cumsum(counts) - counts, counts)
+                       ) * self.rows
+        starts = np.searchsorted(self.keys, column_keys + low[queries])
+        lengths = np.searchsorted(self.keys, column_keys + high[queries],
+                                  'right') - starts
+        positions = np.arange(lengths.sum()) + np.repeat(
+            starts - np.cumsum(lengths) + lengths, lengths)
+        queries = np.repeat(queries, lengths)
+        distances = np.hypot(self.coords[positions, 0] - xs[queries],
+                             self.coords[positions, 1] - ys[queries])
+        found = distances <= radius[queries]
+        return queries[found], positions[found], distances[found]
+
+    def nearest(self, xs, ys):
+        """Distance from each ``(xs[i], ys[i])`` to its nearest point;
+        ``inf`` when the grid is empty."""
+        xs = np.asarray(xs, dtype=float).ravel()
+        ys = np.asarray(ys, dtype=float).ravel()
+        distances = np.full(len(xs), np.inf)
+        remaining = np.arange(len(xs)) if len(self.keys) else []
+        radius = self.cell_size
+        while len(remaining):
+            queries, _, found = self.within(xs[remaining], ys[remaining],
+                                            radius)
+            np.minimum.at(distances, remaining[queries], found)
+            remaining = remaining[np.isinf(distances[remaining])]
+            radius *= 2
+        return distances
+
+
+class PointSpatialIndex(DerivedStructure):
+    """Every point on a PointGrid, with ``_point_ids`` and ``_coords`` in
+    grid order."""
     _point_ids = []
-    _transformer = Transformer.from_crs("EPSG:4326", "EPSG:32720",
-                                        always_xy=True)
+    snapshot_fields = ('_point_ids', '_coords', '_grid', '_keys')
 
-    def __new__(cls):
-        if cls._instance is None:
-            cls._instance = super(PointSpatialIndex, cls).__new__(cls)
-            cls._instance._build_index()
-        return cls._instance
+    def _build(self):
+        self._build_index()
 
     def _build_index(self):
-        points_data = list(Point.objects.values('id', 'x_coord', 'y_coord'))
-        if not points_data:
-            self._tree = None
-            self._point_ids = []
-            return
-        ids = [p['id'] for p in points_data]
-        xs = [p['x_coord'] for p in points_data]
-        ys = [p['y_coord'] for p in points_data]
-        projected_x, projected_y = self._transformer.transform(xs, ys)
-        coords = np.column_stack((projected_x, projected_y))
-        self._tree = KDTree(coords)
-        self._point_ids = np.array(ids)
-        print(f"Index built with {len(ids)} points.")
-
-    def query_radius(self, target_point_obj, radius_meters=50.0):
-        if self._tree is None:
-            return []
-        target_x, target_y = self._transformer.transform(
-            target_point_obj.x_coord,
-            target_point_obj.y_coord
-        )
-        indices = self._tree.query_ball_point([target_x, target_y],
-                                              radius_meters)
-        found_ids = self._point_ids[indices].tolist()
-        if not found_ids:
-            return []
-        return list(Point.objects.filter(id__in=found_ids))
-
-    def query(self, target_point_obj):
-        if self._tree is None:
-            return []
-        target_x, target_y = self._transformer.transform(
-            target_point_obj.x_coord,
-            target_point_obj.y_coord
-        )
-        _, index = self._tree.query([target_x, target_y], k=1)
-        found_id = self._point_ids[index]
-        return Point.objects.get(id=found_id)
+        point_ids, coords = Point.objects.projected()
+        self._grid, self._keys, order = PointGrid.arrange(coords)
+        self._point_ids = point_ids[order]
+        self._coords = coords[order]
+        self._restore()
+        logger.info("Index built with %d points.", len(self._point_ids))
+
+    def _restore(self):
+        # Only wraps the (possibly mapped) arrays; nothing is copied.
+        self._index = PointGrid(self._grid, self._keys, self._coords)
+
+    def snap(self, x_coords, y_coords, radius_meters=300.0, k=None,
+             fallback_nearest=True):
+        """Snap many coordinates to indexed points without touching the DB.
+
+        Returns one ``(point_ids, distances_m)`` pair of arrays per input
+        coordinate, nearest first with ties in id order. With ``k`` only
+        the ``k`` nearest points inside the radius are kept. Coordinates
+        with nothing in range get their single nearest point when
+        ``fallback_nearest`` is set.
+        """
+        xs, ys = project_coordinates(x_coords, y_coords)
+        xs, ys = np.atleast_1d(xs), np.atleast_1d(ys)
+        queries, positions, distances = self._index.within(
+            xs, ys, radius_meters)
+        limits = np.full(len(xs), len(self._point_ids) if k is None else k)
+        if fallback_nearest:
+            missing = np.setdiff1d(np.arange(len(xs)), queries)
+            if len(missing):
+                # Everything as close as the nearest point, to rank ties.
+                extra = self._index.within(
+                    xs[missing], ys[missing],
+                    self._index.nearest(xs[missing], ys[missing]))
+                queries = np.concatenate((queries, missing[extra[0]]))
+                positions = np.concatenate((positions, extra[1]))
+                distances = np.concatenate((distances, extra[2]))
+                limits[missing] = 1
+        point_ids = self._point_ids[positions]
+        order = np.lexsort((point_ids, distances, queries))
+        queries = queries[order]
+        bounds = np.searchsorted(queries, np.arange(len(xs) + 1))
+        rank = np.arange(len(queries)) - bounds[queries]
+        keep = rank < limits[queries]
+        kept = order[keep]
+        bounds = np.searchsorted(queries[keep], np.arange(len(xs) + 1))
+        point_ids, distances = point_ids[kept], distances[kept]
+        return [(point_ids[bounds[i]:bounds[i + 1]],
+                 distances[bounds[i]:bounds[i + 1]])
+                for i in range(len(xs))]
+
+
+class RouteSpatialIndex(DerivedStructure):
+    """Every stop of every route on a PointGrid, labelled with its route."""
+    _route_ids = []
+    snapshot_fields = ('_route_ids', '_stop_coords', '_grid', '_keys')
+
+    def _build(self):
+        rows = np.array(Step.objects.values_list('route_id', 'point_id'),
+                        dtype=np.int64).reshape(-1, 2)
+        rows = np.unique(rows, axis=0)
+        point_ids, coords = Point.objects.filter(
+            id__in=np.unique(rows[:, 1]).tolist()).projected()
+        if not len(point_ids):
+            rows = rows[:0]
+        coords = coords[np.searchsorted(point_ids, rows[:, 1])]
+        self._grid, self._keys, order = PointGrid.arrange(coords)
+        self._stop_coords = coords[order]
+        self._route_ids = rows[order, 0]
+        self._restore()
+
+    def _restore(self):
+        self._index = PointGrid(self._grid, self._keys, self._stop_coords)
+
+    def routes_within(self, x_coord, y_coord, radius_meters):
+        """Ids of the routes with a stop within ``radius_meters``."""
+        xs, ys = project_coordinates([x_coord], [y_coord])
+        _, positions, _ = self._index.within(xs, ys, radius_meters)
+        return np.unique(self._route_ids[positions]).tolist()
@@ -1,3 +1,936 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import numpy
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.core.serializers import serialize
+from django.db import IntegrityError, transaction
+from django.test import (SimpleTestCase, TestCase, TransactionTestCase,
+                         override_settings)
+from rest_framework.renderers import JSONRenderer
+from .concurrency import SearchLimiter, search_limiter
+from .conditional import response_cache
+from .encoding import decode_polyline, encode_coordinates, encode_polyline
+from .models import (Line, NetworkVersion, Point, Route, Step,
+                     project_coordinates, unproject_coordinates)
+from .graph import TransitGraph
+from .importing import (NetworkDump, iter_fixture, replace_network,
+                        replace_network_staged)
+from .management.commands.buildsnapshot import (
+    STRUCTURES as SNAPSHOT_STRUCTURES)
+from .matrix import distance_matrix, matrix_json
+from .routing import (SEARCH_MODES, AlternativePaths, calculatePaths,
+                      find_best_path, ridden_routes, search_paths,
+                      shared_route_fraction)
+from .serializers import PointSerializer, RouteSerializer
+from .snapshot import load_snapshot, write_snapshot
+from .spatial_index import PointSpatialIndex
+from .tiles import tile_cache, world_coordinates
+from .versioning import (DerivedStructure, bump_network_version,
+                         network_version)
+from .views import best_paths_cache
 
-# Create your tests here.
+
+def reset_derived_structures():
+    for cls in DerivedStructure.registry:
+        cls._instance = None
+    best_paths_cache.clear()
+    response_cache.clear()
+    tile_cache.clear()
+
+
+def wait_for_rebuilds(timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while any(cls._rebuilding for cls in DerivedStructure.registry):
+        if time.monotonic() > deadline:
+            raise AssertionError("Derived structures are still rebuilding.")
+        time.sleep(0.01)
+
+
+def create_route(route_id, line, coords, first_step_id):
+    # Route.first and Step.route point at each other; the constraints are
+    # only checked at commit, so the ids are fixed up front and the caller
+    # creates everything in one transaction.
+    route = Route.objects.create(id=route_id, line=line, isReturn=False,
+                                 distance=1.5, time=0.25,
+                                 first_id=first_step_id)
+    points = [Point.objects.create(x_coord=x, y_coord=y) for x, y in coords]
+    step_ids = range(first_step_id, first_step_id + len(points))
+    for step_id, point in zip(step_ids, points):
+        Step.objects.create(id=step_id, route=route, point=point,
+                            next_id=step_id + 1
+                            if step_id + 1 in step_ids else None)
+    return route
+
+
+def serializer_rendering(best_paths, o_x, o_y, d_x, d_y, geometry_format):
+    """BestRoutesView output built the way it was before the fast
+    renderer: one DRF serializer per route, point and walking leg."""
+    walking = [RouteSerializer(Route(
+        id=route_id, line=Line(id=line_id, name="L000", color="#000000"),
+        isReturn=False, distance=0, time=0)).data
+        for route_id, line_id in ((999, 998), (1001, 1000))]
+    result = []
+    for steps, distance in best_paths:
+        segments = []
+        for step in steps:
+            if not segments or segments[-1]["route"]["id"] != step.route.id:
+                segments.append({"route": RouteSerializer(step.route).data,
+                                 "path": []})
+            segments[-1]["path"].append(PointSerializer(step.point).data)
+        segments[-1]["path"].append(PointSerializer(steps[-1].point).data)
+        segments = ([{"route": walking[0], "path": [
+            PointSerializer(Point(x_coord=o_x, y_coord=o_y)).data,
+            PointSerializer(steps[0].point).data]}] + segments +
+            [{"route": walking[1], "path": [
+                PointSerializer(steps[-1].point).data,
+                PointSerializer(Point(x_coord=d_x, y_coord=d_y)).data]}])
+        if geometry_format != 'points':
+            for segment in segments:
+                segment["path"] = encode_coordinates(
+                    [(p["x_coord"], p["y_coord"]) for p in segment["path"]],
+                    geometry_format, 5)
+        result.append({"distance": distance, "segments": segments})
+    return JSONRenderer().render(result)
+
+
+def create_network():
+    with transaction.atomic():
+        line = Line.objects.create(name="L001", color="#ff0000")
+        other = Line.objects.create(name="L002", color="#00ff00")
+        create_route(1, line, [(-17.7800, -63.1800), (-17.7810, -63.1790),
+                               (-17.7820, -63.1780), (-17.7830, -63.1770)],
+                     100)
+        create_route(2, other, [(-17.7830, -63.1771), (-17.7850, -63.1761),
+                                (-17.7870, -63.1750)], 200)
+        create_route(3, line, [(-17.7802, -63.1801), (-17.7840, -63.1780),
+                               (-17.7869, -63.1752)], 300)
+
+
+class PolylineTests(SimpleTestCase):
+    # Google's reference example.
+    coords = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+
+    def test_reference_value(self):
+        self.assertEqual(encode_polyline(self.coords),
+                         '_p~iF~ps|U_ulLnnqC_mqNvxq`@')
+
+    def test_round_trip(self):
+        coords = numpy.array([(-17.78312, -63.18245), (-17.78301, -63.1801),
+                              (-17.7, -63.2), (0.0, 0.0), (-90.0, 179.99999)])
+        for precision in (5, 6):
+            with self.subTest(precision=precision):
+                numpy.testing.assert_allclose(
+                    decode_polyline(encode_polyline(coords, precision),
+                                    precision),
+                    coords, atol=0.5 * 10.0 ** -precision)
+        self.assertEqual(decode_polyline('').shape, (0, 2))
+
+
+# The routing views run on their own threads and database connections, so
+# test data has to be committed for them to see it.
+@override_settings(ROUTING_PATH_CACHE_SIZE=0)
+class BestRoutesRenderingTests(TransactionTestCase):
+    origin = (-17.7801, -63.1800)
+    destination = (-17.7870, -63.1751)
+
+    def setUp(self):
+        create_network()
+        reset_derived_structures()
+
+    def expected(self, alternatives, geometry_format='points'):
+        (start_ids, start_dists), (end_ids, end_dists) = (
+            PointSpatialIndex().snap(
+                [self.origin[0], self.destination[0]],
+                [self.origin[1], self.destination[1]], radius_meters=300.0))
+        best_paths = calculatePaths(
+            start_ids.tolist(), end_ids.tolist(),
+            dict(zip(start_ids.tolist(), start_dists.tolist())),
+            dict(zip(end_ids.tolist(), end_dists.tolist())),
+            alternatives, 200.0, 5)
+        self.assertTrue(best_paths)
+        return serializer_rendering(best_paths, *self.origin,
+                                    *self.destination, geometry_format)
+
+    def url(self, query=''):
+        return '/api/routes/best/%r/%r/%r/%r%s' % (
+            self.origin + self.destination + (query,))
+
+    def test_matches_serializer_rendering(self):
+        response = self.client.get(self.url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, self.expected(5))
+
+    def test_matches_serializer_rendering_single_path(self):
+        response = self.client.get(self.url('?alternatives=1'))
+        self.assertEqual(response.content, self.expected(1))
+
+    def test_matches_serializer_rendering_encoded(self):
+        response = self.client.get(self.url('?geometry=polyline'))
+        self.assertEqual(response.content, self.expected(5, 'polyline'))
+
+    def test_search_mode_needs_single_path(self):
+        response = self.client.get(self.url('?search=astar'))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(self.url('?search=astar&alternatives=1'))
+        self.assertEqual(response.content, self.expected(1))
+
+    def test_non_finite_coordinates(self):
+        response = self.client.get('/api/routes/best/nan/%r/%r/%r' % (
+            self.origin[1:] + self.destination))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/routes/best/batch', {
+            "pairs": [["inf", *self.origin[1:], *self.destination],
+                      [*self.origin, *self.destination]],
+            "alternatives": 1}, content_type='application/json')
+        lines = [json.loads(line) for line in
+                 b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(lines[0], {"index": 0,
+                                    "error": "Coordinates must be finite."})
+        self.assertEqual(len(lines[1]["paths"]), 1)
+
+    def take_free_slots(self):
+        taken = 0
+        while search_limiter.enter():
+            taken += 1
+        return taken
+
+    def release_slots(self, count):
+        for _ in range(count):
+            search_limiter.leave()
+
+    def batch(self, pairs):
+        return self.client.post('/api/routes/best/batch', {
+            "pairs": pairs, "alternatives": 1},
+            content_type='application/json')
+
+    def test_busy_search_views(self):
+        free = self.take_free_slots()
+        try:
+            for response in (
+                    self.client.get('/api/routes/reach/%r/%r/500' %
+                                    self.origin),
+                    self.client.post('/api/network/matrix', {"origins": [1]},
+                                     content_type='application/json'),
+                    self.batch([[*self.origin, *self.destination]])):
+                self.assertEqual(response.status_code, 503)
+                self.assertIn('Retry-After', response)
+        finally:
+            self.release_slots(free)
+
+    @override_settings(ROUTING_BATCH_MAX_IN_FLIGHT=1)
+    def test_batch_holds_a_slot_while_streaming(self):
+        destinations = [(-17.7870, -63.1751), (-17.7830, -63.1771),
+                        (-17.7840, -63.1780)]
+        pairs = [[*self.origin, *destination]
+                 for destination in destinations * 2]
+        free = self.take_free_slots()
+        self.release_slots(free)
+        response = self.batch(pairs)
+        self.assertEqual(self.take_free_slots(), free - 1)
+        self.release_slots(free - 1)
+        lines = [json.loads(line) for line in
+                 b''.join(response.streaming_content).splitlines()]
+        response.close()
+        self.assertEqual(self.take_free_slots(), free)
+        self.release_slots(free)
+        self.assertEqual([line["index"] for line in lines], list(range(6)))
+        self.assertEqual(lines[:3], [dict(line, index=index)
+                                     for index, line in enumerate(lines[3:])])
+        for line, destination in zip(lines, destinations):
+            alone = json.loads(self.batch(
+                [[*self.origin, *destination]]).getvalue())
+            self.assertEqual(line["paths"], alone["paths"])
+        # A response dropped before it streams gives its slot back too.
+        self.batch(pairs).close()
+        self.assertEqual(self.take_free_slots(), free)
+        self.release_slots(free)
+
+    def test_reach_budget_must_be_finite_and_not_negative(self):
+        for budget in ('-1', 'inf', 'nan'):
+            with self.subTest(budget=budget):
+                response = self.client.get('/api/routes/reach/%r/%r/%s' % (
+                    self.origin + (budget,)))
+                self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/routes/reach/%r/%r/0' % self.origin)
+        self.assertEqual(response.status_code, 200)
+
+
+class TransitGraphTests(TestCase):
+    def setUp(self):
+        # Points without steps shift point indices away from step indices.
+        for offset in range(5):
+            Point.objects.create(x_coord=-17.70 - offset / 100,
+                                 y_coord=-63.10)
+        create_network()
+        reset_derived_structures()
+
+    def test_walks_join_nearby_stops(self):
+        graph = TransitGraph()
+        end = Step.objects.get(id=103).point
+        start = Step.objects.get(id=200).point
+        walks = dict(graph.walks_from(graph.point_index(end.id)))
+        self.assertIn(graph.point_index(start.id), walks)
+        self.assertAlmostEqual(
+            walks[graph.point_index(start.id)],
+            float(numpy.linalg.norm(end.__array__() - start.__array__())))
+        stops = sorted(set(graph._point))
+        expected = {
+            (a, b) for a in stops for b in stops if a != b and
+            numpy.linalg.norm(graph.point_coords[a] - graph.point_coords[b])
+            <= settings.ROUTING_MAX_TRANSFER_WALK}
+        self.assertTrue(expected)
+        self.assertEqual({(point, target)
+                          for point in range(len(graph.point_ids))
+                          for target, _ in graph.walks_from(point)},
+                         expected)
+
+
+def coordinates_at(origin, offsets):
+    """``(x_coord, y_coord)`` pairs ``offsets`` metres away from
+    ``origin`` in the projected plane."""
+    x, y = project_coordinates([origin[0]], [origin[1]])
+    xs, ys = unproject_coordinates(
+        x[0] + numpy.array([dx for dx, _ in offsets], dtype=float),
+        y[0] + numpy.array([dy for _, dy in offsets], dtype=float))
+    return list(zip(xs.tolist(), ys.tolist()))
+
+
+class PointSpatialIndexTests(TestCase):
+    origin = (-17.7800, -63.1800)
+
+    def setUp(self):
+        # 10 m east, 20 m north and south (a tie), 400 m west.
+        self.points = [
+            Point.objects.create(x_coord=x, y_coord=y)
+            for x, y in coordinates_at(
+                self.origin, ((10, 0), (0, 20), (0, -20), (-400, 0)))]
+        reset_derived_structures()
+        self.far = coordinates_at(self.origin, ((1000, 0),))[0]
+
+    def snap(self, **kwargs):
+        snapped = PointSpatialIndex().snap(
+            [self.origin[0], self.far[0]], [self.origin[1], self.far[1]],
+            **kwargs)
+        return [(ids.tolist(), numpy.round(distances, 3).tolist())
+                for ids, distances in snapped]
+
+    def test_ranking_within_radius(self):
+        ids = [point.id for point in self.points]
+        self.assertEqual(self.snap(radius_meters=50.0), [
+            (ids[:3], [10.0, 20.0, 20.0]), (ids[:1], [990.0])])
+
+    def test_k_nearest(self):
+        ids = [point.id for point in self.points]
+        self.assertEqual(self.snap(radius_meters=500.0, k=2)[0],
+                         (ids[:2], [10.0, 20.0]))
+
+    def test_nothing_in_range(self):
+        self.assertEqual(self.snap(radius_meters=50.0,
+                                   fallback_nearest=False)[1], ([], []))
+        self.assertEqual(self.snap(radius_meters=5.0)[0],
+                         ([self.points[0].id], [10.0]))
+
+
+class AlternativePathsTests(TestCase):
+    """Three corridors 3 km long, each starting and ending 200 m from the
+    origin and destination, plus a branch leaving the straight corridor
+    halfway, whose paths ride that corridor for more than half their
+    length."""
+    origin = (-17.7800, -63.1800)
+
+    def setUp(self):
+        with transaction.atomic():
+            line = Line.objects.create(name="L001", color="#ff0000")
+            corridors = (((-200, 0), (1500, 0), (3200, 0)),
+                         ((100, 173), (1500, 1000), (2900, 173)),
+                         ((100, -173), (1500, -1000), (2900, -173)),
+                         ((1500, 0), (3000, 250)))
+            for number, offsets in enumerate(corridors, 1):
+                create_route(number, line,
+                             coordinates_at(self.origin, offsets),
+                             number * 100)
+        reset_derived_structures()
+        self.graph = TransitGraph()
+        point_ids = {step.id: step.point_id for step in Step.objects.all()}
+        self.start_costs = {point_ids[step]: 200.0
+                            for step in (100, 200, 300)}
+        self.end_costs = {point_ids[step]: 200.0
+                          for step in (102, 202, 302)}
+        self.end_costs[point_ids[401]] = 250.0
+
+    def search(self, alternatives):
+        return search_paths(self.graph, list(self.start_costs),
+                            list(self.end_costs), self.start_costs,
+                            self.end_costs, alternatives, 200.0, 5)
+
+    def test_alternatives(self):
+        paths = self.search(3)
+        self.assertEqual(len(paths), 3)
+        self.assertEqual(paths[0][0], self.search(1)[0][0])
+        distances = [distance for _, distance in paths]
+        self.assertEqual(distances, sorted(distances))
+        for path, _ in paths:
+            points = [self.graph._point[step] for step in path]
+            self.assertEqual(len(points), len(set(points)))
+        ridden = [ridden_routes(self.graph, path) for path, _ in paths]
+        for i, earlier in enumerate(ridden):
+            for later in ridden[i + 1:]:
+                self.assertLessEqual(
+                    shared_route_fraction(later, set(earlier)),
+                    settings.ROUTING_MAX_SHARED_FRACTION)
+
+    def test_candidate_costs_do_not_decrease(self):
+        engine = AlternativePaths(
+            self.graph,
+            {self.graph.point_index(p): c * 5
+             for p, c in self.start_costs.items()},
+            {self.graph.point_index(p): c * 5
+             for p, c in self.end_costs.items()}, 200.0, 5)
+        costs = [cost for _, cost in engine.paths(10)]
+        self.assertGreater(len(costs), 3)
+        self.assertEqual(costs, sorted(costs))
+
+    def test_fewer_diverse_paths_than_asked(self):
+        paths = self.search(5)
+        self.assertEqual(len(paths), 3)
+        branch = self.graph.route_ids.tolist().index(4)
+        for path, _ in paths:
+            self.assertNotIn(branch, ridden_routes(self.graph, path))
+
+
+class SearchModeTests(TestCase):
+    def setUp(self):
+        create_network()
+        reset_derived_structures()
+
+    def test_modes_match_dijkstra(self):
+        graph = TransitGraph()
+        stops = sorted(set(graph._point))
+        for start in stops:
+            start_costs = {start: 10.0}
+            start_steps = list(graph.steps_at(start))
+            for end in stops:
+                expected = find_best_path(graph, start_steps, {end: 10.0},
+                                          200.0, start_costs, 'dijkstra', 5)
+                for mode in SEARCH_MODES:
+                    with self.subTest(start=start, end=end, mode=mode):
+                        found = find_best_path(graph, start_steps,
+                                               {end: 10.0}, 200.0,
+                                               start_costs, mode, 5)
+                        self.assertAlmostEqual(found[1], expected[1])
+
+
+# The matrix view runs on a worker thread; see BestRoutesRenderingTests.
+class DistanceMatrixTests(TransactionTestCase):
+    """Route 1 rides 1000 m twice eastwards and stops 100 m from the start
+    of route 2, which rides 1000 m north; route 3 is out of walking
+    reach."""
+    origin = (-17.7800, -63.1800)
+    expected = [[0.0, 1000.0, 2000.0, 2100.0, 3100.0, None],
+                [None, 0.0, 1000.0, 1100.0, 2100.0, None],
+                [None, None, 0.0, 100.0, 1100.0, None],
+                [None, None, 100.0, 0.0, 1000.0, None],
+                [None, None, None, None, 0.0, None],
+                [None, None, None, None, None, 0.0]]
+
+    def setUp(self):
+        with transaction.atomic():
+            line = Line.objects.create(name="L001", color="#ff0000")
+            for number, offsets in enumerate((
+                    ((0, 0), (1000, 0), (2000, 0)),
+                    ((2000, 100), (2000, 1100)),
+                    ((5000, 5000), (6000, 5000))), 1):
+                create_route(number, line,
+                             coordinates_at(self.origin, offsets),
+                             number * 100)
+        reset_derived_structures()
+        self.point_ids = [Step.objects.get(id=step).point_id
+                          for step in (100, 101, 102, 200, 201, 300)]
+
+    def assertMatrix(self, distances):
+        self.assertEqual(len(distances), len(self.expected))
+        for row, expected_row in zip(distances, self.expected):
+            self.assertEqual([d is None for d in row],
+                             [d is None for d in expected_row])
+            for distance, expected in zip(row, expected_row):
+                if expected is not None:
+                    self.assertAlmostEqual(distance, expected, places=3)
+
+    def test_matrix(self):
+        graph = TransitGraph()
+        matrix = distance_matrix(graph, self.point_ids, self.point_ids)
+        self.assertMatrix(matrix_json((), (), matrix)["distances"])
+        # The walk and the ride after it, as found by the path search.
+        (_, cost), = search_paths(graph, self.point_ids[:1],
+                                  self.point_ids[4:5], {}, {}, K=1)
+        self.assertAlmostEqual(matrix[0, 4], cost, places=3)
+
+    def test_view(self):
+        response = self.client.post(
+            '/api/network/matrix', {"origins": self.point_ids},
+            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["origins"], self.point_ids)
+        self.assertEqual(body["destinations"], self.point_ids)
+        self.assertMatrix(body["distances"])
+        unknown = self.client.post(
+            '/api/network/matrix?format=npy',
+            {"origins": self.point_ids[:1], "destinations": [0]},
+            content_type='application/json')
+        self.assertEqual(unknown.status_code, 400)
+        self.assertEqual(unknown['Content-Type'], 'application/json')
+
+    def test_command(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'matrix.json')
+            call_command('distancematrix', path, stdout=io.StringIO(),
+                         origins=self.point_ids, chunk_size=2)
+            with open(path) as output:
+                self.assertMatrix(json.load(output)["distances"])
+            path = os.path.join(directory, 'matrix.npy')
+            call_command('distancematrix', path, stdout=io.StringIO(),
+                         origins=self.point_ids, chunk_size=4)
+            matrix = numpy.load(path)
+            self.assertEqual(matrix.dtype, numpy.float32)
+            self.assertMatrix(matrix_json((), (), matrix)["distances"])
+            ids = numpy.load(os.path.join(directory, 'matrix.ids.npz'))
+            self.assertEqual(ids['destinations'].tolist(), self.point_ids)
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        create_network()
+        reset_derived_structures()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(
+            ROUTING_SNAPSHOT_DIR=directory.name))
+
+    def test_round_trip(self):
+        call_command('buildsnapshot', stdout=io.StringIO())
+        reset_derived_structures()
+        for cls in SNAPSHOT_STRUCTURES:
+            loaded, built = cls(), cls._create(use_snapshot=False)
+            self.assertEqual(loaded.source, 'snapshot')
+            for field in cls.snapshot_fields:
+                with self.subTest(structure=cls.__name__, field=field):
+                    array = getattr(loaded, field)
+                    self.assertIsInstance(array, numpy.memmap)
+                    numpy.testing.assert_array_equal(
+                        array, numpy.asarray(getattr(built, field)))
+        graph = TransitGraph()
+        self.assertIsInstance(graph._next.obj, numpy.memmap)
+        built = TransitGraph._create(use_snapshot=False)
+        for point in range(len(graph.point_ids)):
+            self.assertEqual(list(graph.walks_from(point)),
+                             list(built.walks_from(point)))
+
+    def test_rewritten_snapshot(self):
+        version = network_version()
+        write_snapshot([TransitGraph._create(use_snapshot=False)], version)
+        self.assertIsNotNone(load_snapshot(TransitGraph, version))
+        with override_settings(ROUTING_MAX_TRANSFER_WALK=50.0):
+            write_snapshot([TransitGraph._create(use_snapshot=False)],
+                           version)
+            self.assertIsNotNone(load_snapshot(TransitGraph, version))
+        self.assertIsNone(load_snapshot(TransitGraph, version))
+
+
+class NetworkImportTests(TestCase):
+    def setUp(self):
+        create_network()
+        self.fixture = serialize('json', [
+            *Line.objects.all(), *Point.objects.all(), *Route.objects.all(),
+            *Step.objects.all()])
+        self.records = json.loads(self.fixture)
+
+    def test_iter_fixture_chunks(self):
+        for chunk_size in (1, 2, 7, 64, 1 << 16):
+            with self.subTest(chunk_size=chunk_size):
+                stream = io.StringIO(' \n' + self.fixture + '\n')
+                self.assertEqual(list(iter_fixture(stream, chunk_size)),
+                                 self.records)
+        self.assertEqual(list(iter_fixture(io.StringIO(' [ ] '), 1)), [])
+
+    def test_iter_fixture_malformed(self):
+        for text in ('', '   ', '{}', '[{"pk": 1}, nope]', '[{"pk": 1}}]'):
+            with self.subTest(text=text), self.assertRaises(ValueError):
+                list(iter_fixture(io.StringIO(text), 4))
+        # Every truncation fails rather than yielding a shorter network.
+        for end in range(0, len(self.fixture), 37):
+            with self.subTest(end=end), self.assertRaises(ValueError):
+                list(iter_fixture(io.StringIO(self.fixture[:end]), 16))
+
+    def dump_with(self, change):
+        records = json.loads(self.fixture)
+        change(records)
+        return NetworkDump(records)
+
+    def record(self, records, model, pk):
+        return next(record for record in records
+                    if record['model'] == model and record['pk'] == pk)
+
+    def test_checks(self):
+        def dangling_next(records):
+            self.record(records, 'routecalc.step', 101)['fields'][
+                'next'] = 999
+
+        def unknown_point(records):
+            self.record(records, 'routecalc.step', 101)['fields'][
+                'point'] = 999
+
+        def duplicate_point(records):
+            records.append(next(record for record in records
+                                if record['model'] == 'routecalc.point'))
+
+        def duplicate_step(records):
+            records.append(self.record(records, 'routecalc.step', 200))
+
+        def unknown_first(records):
+            self.record(records, 'routecalc.route', 2)['fields'][
+                'first'] = 100
+
+        for change, message in (
+                (dangling_next, "Steps reference missing next steps: 999."),
+                (unknown_point, "Steps reference missing points: 999."),
+                (duplicate_point, "Duplicate point ids in the fixture."),
+                (duplicate_step, "Duplicate step ids in the fixture."),
+                (unknown_first, "Routes start at a step of another route: "
+                                "2.")):
+            with self.subTest(change.__name__):
+                with self.assertRaisesMessage(ValueError, message):
+                    self.dump_with(change)
+
+    def test_replace_network(self):
+        def shifted(records):
+            for record in records:
+                record['pk'] += 1000
+                fields = record['fields']
+                for name in ('line', 'first', 'route', 'point', 'next'):
+                    if fields.get(name) is not None:
+                        fields[name] += 1000
+
+        replace_network(self.dump_with(shifted), batch_size=2)
+        self.assertEqual(sorted(Route.objects.values_list('id', flat=True)),
+                         [1001, 1002, 1003])
+        self.assertEqual(Step.objects.count(), len(
+            [r for r in self.records if r['model'] == 'routecalc.step']))
+        self.assertFalse(Step.objects.filter(
+            sequence__isnull=True).exists())
+
+    def test_replace_network_rolls_back(self):
+        def invalid_route(records):
+            self.record(records, 'routecalc.route', 3)['fields'][
+                'time'] = None
+
+        dump = self.dump_with(invalid_route)
+        version = NetworkVersion.current()
+        # Lines and points are already replaced when the routes fail.
+        with self.assertRaises(IntegrityError):
+            replace_network(dump)
+        self.assertEqual(serialize('json', [
+            *Line.objects.all(), *Point.objects.all(), *Route.objects.all(),
+            *Step.objects.all()]), self.fixture)
+        self.assertEqual(NetworkVersion.current(), version)
+
+    def test_staged_import_needs_postgresql(self):
+        with self.assertRaisesMessage(ValueError, "needs PostgreSQL"):
+            replace_network_staged(NetworkDump(self.records))
+        with self.assertRaisesMessage(CommandError, "needs PostgreSQL"):
+            call_command('importnetwork', 'missing.json', staged=True)
+
+
+class RouteUploadTests(TestCase):
+    def setUp(self):
+        create_network()
+        reset_derived_structures()
+        self.line = Line.objects.get(name="L002")
+        self.near = [Step.objects.get(id=step).point for step in (100, 201)]
+        origin = (self.near[0].x_coord, self.near[0].y_coord)
+        # 3 m from step 100's point, 15 m from it, 600 m away, then step
+        # 201's point itself.
+        self.coordinates = coordinates_at(origin,
+                                          ((3, 0), (0, 15), (600, 0))) + [
+            (self.near[1].x_coord, self.near[1].y_coord)]
+
+    def upload(self, **payload):
+        return self.client.post('/api/routes/upload', dict({
+            "line": self.line.id, "isReturn": True, "time": 0.5,
+            "coordinates": self.coordinates}, **payload),
+            content_type='application/json')
+
+    def test_upload(self):
+        points = Point.objects.count()
+        response = self.upload(snap_tolerance=10.0)
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual((body["steps"], body["points_created"],
+                          body["points_reused"]), (4, 2, 2))
+        self.assertEqual(Point.objects.count(), points + 2)
+
+        route = Route.objects.get(id=body["route"]["id"])
+        steps = {step.id: step for step in route.step_set.all()}
+        chain = [steps[route.first_id]]
+        while chain[-1].next_id is not None:
+            chain.append(steps[chain[-1].next_id])
+        self.assertEqual(len(chain), len(steps))
+        self.assertEqual([step.sequence for step in chain], [0, 1, 2, 3])
+        self.assertEqual(chain[0].point_id, self.near[0].id)
+        self.assertEqual(chain[3].point_id, self.near[1].id)
+        self.assertNotIn(chain[1].point_id, (self.near[0].id,
+                                             self.near[1].id))
+        for step, (x, y) in list(zip(chain, self.coordinates))[1:3]:
+            self.assertAlmostEqual(step.point.x_coord, x)
+            self.assertAlmostEqual(step.point.y_coord, y)
+
+        coords = numpy.array([step.point.__array__() for step in chain])
+        segments = numpy.linalg.norm(numpy.diff(coords, axis=0), axis=1)
+        for step, segment, distance in zip(
+                chain, segments.tolist() + [0.0],
+                [0.0] + numpy.cumsum(segments).tolist()):
+            self.assertAlmostEqual(step.segment_length, segment)
+            self.assertAlmostEqual(step.cumulative_distance, distance)
+        self.assertAlmostEqual(route.distance, segments.sum() / 1000.0)
+        self.assertEqual((route.line_id, route.isReturn, route.time),
+                         (self.line.id, True, 0.5))
+
+    def test_default_tolerance_and_zero_tolerance(self):
+        body = self.upload().json()
+        self.assertEqual(body["points_reused"], 2)
+        reset_derived_structures()
+        body = self.upload(snap_tolerance=0.0).json()
+        # Only the points of the first upload and step 201's point match
+        # exactly; the coordinate 3 m from step 100's point gets a new one.
+        self.assertEqual((body["points_reused"], body["points_created"]),
+                         (3, 1))
+
+    @override_settings(ROUTING_UPLOAD_MAX_STOPS=4)
+    def test_invalid_payloads(self):
+        steps = Step.objects.count()
+        for payload in ({"coordinates": self.coordinates[:1]},
+                        {"coordinates": [[-17.78, -63.18, 0.0]] * 2},
+                        {"coordinates": [[-17.78, "east"]] * 2},
+                        {"line": 999},
+                        {"isReturn": None},
+                        {"time": -1},
+                        {"snap_tolerance": -5},
+                        {"coordinates": self.coordinates * 2}):
+            with self.subTest(payload=payload):
+                response = self.upload(**payload)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(set(response.json()), set(payload))
+        self.assertEqual(Step.objects.count(), steps)
+
+
+# The network version is read once in setUp and not polled again, so that
+# only the queries of the views themselves are counted.
+@override_settings(ROUTING_PAGE_SIZE=2, ROUTING_RESPONSE_CACHE_SIZE=0,
+                   ROUTING_VERSION_POLL_INTERVAL=3600.0)
+class NetworkListQueryTests(TestCase):
+    # Queries per page, whatever the page size.
+    listings = (('/api/lines/', Line, 2), ('/api/points/', Point, 1),
+                ('/api/steps/', Step, 1), ('/api/routes/', Route, 1))
+
+    def setUp(self):
+        create_network()
+        reset_derived_structures()
+        network_version()
+
+    def test_constant_queries_per_page(self):
+        for url, model, queries in self.listings:
+            for query in ('', '?page_size=3', '?page_size=1000'):
+                with self.subTest(url=url + query):
+                    results = 0
+                    page = url + query
+                    while page:
+                        with self.assertNumQueries(queries):
+                            response = self.client.get(page)
+                        self.assertEqual(response.status_code, 200)
+                        results += len(response.json()["results"])
+                        page = response.json()["next"]
+                    self.assertEqual(results, model.objects.count())
+
+    def test_page_size_is_capped(self):
+        with self.settings(ROUTING_MAX_PAGE_SIZE=4):
+            response = self.client.get('/api/points/?page_size=1000')
+        self.assertEqual(len(response.json()["results"]), 4)
+
+    def test_retrieve_single_query(self):
+        for url in ('/api/steps/100/', '/api/routes/1/'):
+            with self.subTest(url=url), self.assertNumQueries(1):
+                self.assertEqual(self.client.get(url).status_code, 200)
+        line = Line.objects.first()
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                self.client.get(f'/api/lines/{line.pk}/').status_code, 200)
+
+
+@override_settings(ROUTING_MAX_CONCURRENT_SEARCHES=1)
+class SearchLimiterTests(SimpleTestCase):
+    def test_cancelled_request_keeps_its_slot(self):
+        limiter = SearchLimiter()
+        finish = threading.Event()
+
+        async def cancel_while_running():
+            self.assertTrue(limiter.enter())
+            started = threading.Event()
+            task = asyncio.ensure_future(limiter.run(
+                lambda: started.set() or finish.wait(5)))
+            await asyncio.get_running_loop().run_in_executor(
+                None, started.wait, 5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(cancel_while_running())
+        self.assertFalse(limiter.enter())
+        finish.set()
+        # The single worker releases the slot before taking the next job.
+        limiter._executor.submit(lambda: None).result()
+        self.assertTrue(limiter.enter())
+        limiter.leave()
+
+
+class NetworkVersionTests(TestCase):
+    def test_bump(self):
+        before = NetworkVersion.current()
+        NetworkVersion.bump()
+        self.assertEqual(NetworkVersion.current(), before + 1)
+
+    def test_bump_recreates_missing_row(self):
+        NetworkVersion.objects.all().delete()
+        NetworkVersion.bump()
+        NetworkVersion.bump()
+        self.assertEqual(NetworkVersion.current(), 2)
+
+
+class VersionedCacheTests(TestCase):
+    def test_values_from_older_versions_are_not_stored(self):
+        old = network_version(refresh=True)
+        bump_network_version()
+        best_paths_cache.clear()
+        best_paths_cache.put('stale', 1, old)
+        best_paths_cache.put('fresh', 2, network_version())
+        self.assertIsNone(best_paths_cache.get('stale'))
+        self.assertEqual(best_paths_cache.get('fresh'), 2)
+
+
+class NetworkEditTests(TestCase):
+    def setUp(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            create_network()
+
+    def test_network_creation_is_one_change(self):
+        self.assertEqual(NetworkVersion.current(), 1)
+        self.assertFalse(Step.objects.filter(sequence=None).exists())
+
+    def test_edits_keep_steps_measured(self):
+        point = Step.objects.get(id=101).point
+        before = Step.objects.get(id=102).cumulative_distance
+        point.x_coord += 0.001
+        with self.captureOnCommitCallbacks(execute=True):
+            point.save()
+        self.assertFalse(Step.objects.filter(sequence=None).exists())
+        self.assertNotAlmostEqual(
+            Step.objects.get(id=102).cumulative_distance, before)
+        self.assertEqual(list(Step.objects.filter(route_id=1).order_by(
+            'sequence').values_list('id', flat=True)), [100, 101, 102, 103])
+
+    def test_route_deletion_is_one_change(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            Route.objects.get(id=1).delete()
+        self.assertEqual(NetworkVersion.current(), 2)
+        self.assertFalse(Step.objects.filter(route_id=1).exists())
+        # One callback per deleted row, all but the first finding nothing
+        # left to do.
+        self.assertGreater(len(callbacks), 1)
+
+
+@override_settings(ROUTING_VERSION_POLL_INTERVAL=3600.0)
+class NetworkConditionalGetTests(TestCase):
+    def setUp(self):
+        create_network()
+        reset_derived_structures()
+        network_version()
+
+    def test_not_modified_without_queries(self):
+        response = self.client.get('/api/lines/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=', response['Cache-Control'])
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                '/api/lines/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_cached_body_without_queries(self):
+        first = self.client.get('/api/points/?page_size=3')
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/points/?page_size=3')
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_network_change_invalidates(self):
+        first = self.client.get('/api/lines/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Line.objects.create(name="L003", color="#0000ff")
+        response = self.client.get('/api/lines/',
+                                   HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertIn(b"L003", response.content)
+
+
+@override_settings(ROUTING_VERSION_POLL_INTERVAL=0.0)
+class StaleStructureResponseTests(TransactionTestCase):
+    def setUp(self):
+        create_network()
+        reset_derived_structures()
+        self.url = '/api/lines/%d/routes' % Route.objects.get(id=1).line_id
+
+    def test_line_routes_after_point_edit(self):
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        point = Step.objects.get(id=101).point
+        point.x_coord = -17.7815
+        point.save()
+        # The geometry is rebuilt in the background; meanwhile the old one
+        # is served without an ETag and not cached.
+        stale = self.client.get(self.url)
+        self.assertNotIn('ETag', stale)
+        wait_for_rebuilds()
+        response = self.client.get(self.url,
+                                   HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+        self.assertIn(b'-17.7815', response.content)
+        cached = self.client.get(self.url)
+        self.assertEqual(cached.content, response.content)
+
+    def test_tiles_after_point_edit(self):
+        def tile_url(point):
+            x, y = (world_coordinates([(point.x_coord, point.y_coord)])[0] *
+                    2 ** 16).astype(int).tolist()
+            return '/api/tiles/16/%d/%d' % (x, y)
+
+        point = Step.objects.get(id=101).point
+        old_url = tile_url(point)
+        self.assertIn(point.id,
+                      self.client.get(old_url).json()["stops"]["ids"])
+        point.x_coord += 0.01
+        point.y_coord += 0.01
+        point.save()
+        new_url = tile_url(point)
+        self.assertNotEqual(new_url, old_url)
+        self.client.get(old_url)
+        wait_for_rebuilds()
+        self.assertNotIn(point.id,
+                         self.client.get(old_url).json()["stops"]["ids"])
+        self.assertIn(point.id,
+                      self.client.get(new_url).json()["stops"]["ids"])
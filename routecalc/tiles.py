@@ -0,0 +1,212 @@
+import math
+import threading
+import numpy as np
+from .cache import VersionedLRUCache
+from .encoding import MAX_PRECISION
+from .geometry import route_stops
+from .models import Point
+from .rendering import RouteMetadata, encode_json, encode_path
+from .versioning import DerivedStructure
+
+# Pixels across a tile. Vertices falling on the same pixel are merged, which
+# sets the level of detail of each zoom.
+TILE_RESOLUTION = 512
+# Margin around each tile, as a fraction of its size, so that lines and
+# stops crossing its edges are drawn without seams.
+TILE_BUFFER = 1 / 32
+MAX_LATITUDE = 85.0511287798
+
+tile_cache = VersionedLRUCache('ROUTING_TILE_CACHE_SIZE',
+                               'ROUTING_TILE_CACHE_TTL')
+
+
+def world_coordinates(coords):
+    """Web Mercator position, from 0 to 1 on both axes, of ``(x_coord,
+    y_coord)`` pairs, which hold latitude and longitude."""
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    latitude = np.radians(np.clip(coords[:, 0], -MAX_LATITUDE,
+                                  MAX_LATITUDE))
+    return np.column_stack((
+        (coords[:, 1] + 180.0) / 360.0,
+        (1.0 - np.arcsinh(np.tan(latitude)) / np.pi) / 2.0))
+
+
+def geographic_coordinates(world):
+    """Inverse of ``world_coordinates``."""
+    world = np.asarray(world, dtype=float).reshape(-1, 2)
+    return np.column_stack((
+        np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * world[:, 1])))),
+        world[:, 0] * 360.0 - 180.0))
+
+
+def tile_precision(zoom):
+    """Decimal places that resolve one pixel of a tile at ``zoom``."""
+    pixels_per_degree = (2 ** zoom) * TILE_RESOLUTION / 360.0
+    return min(max(math.ceil(math.log10(pixels_per_degree)), 0),
+               MAX_PRECISION)
+
+
+def tile_grid(lower, upper, zoom):
+    """Tile membership of items spanning the world boxes ``lower`` to
+    ``upper``, buffered by ``TILE_BUFFER``: sorted tile keys
+    ``x * 2 ** zoom + y`` and the item in each tile, aligned."""
+    tiles = 2 ** zoom
+    first = np.floor((np.minimum(lower, upper) - TILE_BUFFER / tiles) *
+                     tiles).astype(np.int64).clip(0, tiles - 1)
+    last = np.floor((np.maximum(lower, upper) + TILE_BUFFER / tiles) *
+                    tiles).astype(np.int64).clip(0, tiles - 1)
+    width = last[:, 0] - first[:, 0] + 1
+    counts = width * (last[:, 1] - first[:, 1] + 1)
+    items = np.repeat(np.arange(len(counts)), counts)
+    offset = np.arange(len(items)) - np.repeat(np.cumsum(counts) - counts,
+                                               counts)
+    keys = ((first[items, 0] + offset % width[items]) * tiles +
+            first[items, 1] + offset // width[items])
+    order = np.argsort(keys, kind='stable')
+    return keys[order], items[order]
+
+
+def clip_segments(start, end, lower, upper):
+    """Liang-Barsky clipping of the segments ``start`` to ``end`` to the box
+    ``lower``-``upper``. Returns the entry and exit parameters along each
+    segment; segments missing the box have ``t0 > t1``."""
+    t0 = np.zeros(len(start))
+    t1 = np.ones(len(start))
+    delta = end - start
+    for axis in range(2):
+        step, origin = delta[:, axis], start[:, axis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = (lower[axis] - origin) / step
+            b = (upper[axis] - origin) / step
+        inside = (origin >= lower[axis]) & (origin <= upper[axis])
+        parallel = step == 0
+        t0 = np.maximum(t0, np.where(parallel, np.where(inside, -np.inf,
+                                                        np.inf),
+                                     np.minimum(a, b)))
+        t1 = np.minimum(t1, np.where(parallel, np.where(inside, np.inf,
+                                                        -np.inf),
+                                     np.maximum(a, b)))
+    return t0, t1
+
+
+class TileIndex(DerivedStructure):
+    """Stops and route segments in world coordinates, with the tiles each
+    of them touches indexed lazily per zoom level.
+
+    Built from the database rather than from ``TransitGraph`` and
+    ``RouteGeometry``, which may still hold an older version while this one
+    is built.
+    """
+
+    def _build(self):
+        stops = np.array(
+            Point.objects.filter(steps__isnull=False).distinct()
+            .order_by('id').values_list('id', 'x_coord', 'y_coord'),
+            dtype=np.float64
+        ).reshape(-1, 3)
+        self.stop_ids = stops[:, 0].astype(np.int64)
+        self.stop_world = world_coordinates(stops[:, 1:3])
+        self.route_ids, indptr, coords = route_stops()
+        self.vertex_world = world_coordinates(coords)
+        # A segment joins each stop to the next one of the same route.
+        last = np.zeros(len(coords), dtype=bool)
+        last[indptr[1:] - 1] = True
+        self.segment_start = np.flatnonzero(~last)
+        self.segment_route = np.searchsorted(
+            indptr, self.segment_start, side='right') - 1
+        self._grids = {}
+        self._grid_lock = threading.Lock()
+
+    def _grid(self, zoom):
+        grid = self._grids.get(zoom)
+        if grid is None:
+            with self._grid_lock:
+                grid = self._grids.get(zoom)
+                if grid is None:
+                    grid = self._grids[zoom] = (
+                        tile_grid(self.stop_world, self.stop_world, zoom),
+                        tile_grid(self.vertex_world[self.segment_start],
+                                  self.vertex_world[self.segment_start + 1],
+                                  zoom))
+        return grid
+
+    def tile(self, zoom, x, y, with_stops=True):
+        """Stops and route lines of tile ``x``, ``y`` at ``zoom``.
+
+        Returns the stop positions in ``stop_ids``/``stop_world`` and a list
+        of ``(route index, world coordinates)`` pieces of route clipped to
+        the buffered tile, with vertices closer than a pixel merged.
+        """
+        tiles = 2 ** zoom
+        key = x * tiles + y
+        (stop_keys, stop_items), (segment_keys, segment_items) = (
+            self._grid(zoom))
+        stops = np.empty(0, dtype=np.int64)
+        if with_stops:
+            stops = stop_items[np.searchsorted(stop_keys, key):
+                               np.searchsorted(stop_keys, key, 'right')]
+        segments = np.sort(segment_items[
+            np.searchsorted(segment_keys, key):
+            np.searchsorted(segment_keys, key, 'right')])
+
+        lower = (np.array([x, y]) - TILE_BUFFER) / tiles
+        upper = (np.array([x, y]) + 1 + TILE_BUFFER) / tiles
+        start = self.vertex_world[self.segment_start[segments]]
+        end = self.vertex_world[self.segment_start[segments] + 1]
+        t0, t1 = clip_segments(start, end, lower, upper)
+        kept = t0 <= t1
+        segments, start, end = segments[kept], start[kept], end[kept]
+        t0, t1 = t0[kept, None], t1[kept, None]
+        entry = start + t0 * (end - start)
+        exit_ = start + t1 * (end - start)
+
+        pieces = []
+        previous = None
+        for segment, clipped_in, clipped_out, a, b in zip(
+                segments.tolist(), (t0[:, 0] > 0).tolist(),
+                (t1[:, 0] < 1).tolist(), entry, exit_):
+            if (previous is None or segment != previous[0] + 1 or
+                    self.segment_route[segment] !=
+                    self.segment_route[previous[0]] or
+                    clipped_in or previous[1]):
+                piece = [a]
+                pieces.append((int(self.segment_route[segment]), piece))
+            piece.append(b)
+            previous = (segment, clipped_out)
+
+        origin = np.array([x, y]) / tiles
+        simplified = []
+        for route, piece in pieces:
+            piece = np.array(piece)
+            pixels = np.floor((piece - origin) * tiles * TILE_RESOLUTION)
+            moved = np.ones(len(piece), dtype=bool)
+            moved[1:] = (pixels[1:] != pixels[:-1]).any(axis=1)
+            if moved.sum() > 1:
+                simplified.append((route, piece[moved]))
+        return stops, simplified
+
+
+def render_tile(zoom, x, y, geometry_format, stops_min_zoom):
+    """Tile JSON: the stops (from ``stops_min_zoom`` on) and every route
+    crossing the tile with its clipped ``paths``, rounded to the zoom."""
+    index = TileIndex()
+    metadata = RouteMetadata()
+    precision = tile_precision(zoom)
+    stops, pieces = index.tile(zoom, x, y, zoom >= stops_min_zoom)
+
+    def path(world):
+        coords = np.round(geographic_coordinates(world), precision)
+        return encode_path(coords.tolist(), geometry_format, precision)
+
+    paths = {}
+    for route, world in pieces:
+        paths.setdefault(route, []).append(path(world))
+    routes = ','.join(
+        '{"route":%s,"paths":[%s]}' % (
+            metadata.encoded(int(index.route_ids[route])),
+            ','.join(paths[route]))
+        for route in sorted(paths))
+    return ('{"z":%d,"x":%d,"y":%d,"stops":{"ids":%s,"path":%s},'
+            '"routes":[%s]}' % (
+                zoom, x, y, encode_json(index.stop_ids[stops].tolist()),
+                path(index.stop_world[stops]), routes)).encode()
@@ -13,7 +13,19 @@ urlpatterns = [
          views.LineRoutesView.as_view(), name='line-routes'),
     path('routes/range/<str:x_coord>/<str:y_coord>/<str:radius>',
          views.CloseRoutesView.as_view(), name='close-routes'),
+    path('routes/reach/<str:x_coord>/<str:y_coord>/<str:budget>',
+         views.ReachableStopsView.as_view(), name='reachable-stops'),
+    path('routes/upload',
+         views.RouteUploadView.as_view(), name='route-upload'),
+    path('routes/best/batch',
+         views.BatchRoutesView.as_view(), name='batch-routes'),
     path('routes/best/<str:o_x>/<str:o_y>/<str:d_x>/<str:d_y>',
          views.BestRoutesView.as_view(), name='best-routes'),
+    path('tiles/<int:z>/<int:x>/<int:y>',
+         views.TileView.as_view(), name='tile'),
+    path('network/matrix',
+         views.DistanceMatrixView.as_view(), name='distance-matrix'),
+    path('network/status',
+         views.NetworkStatusView.as_view(), name='network-status'),
     path('', include(router.urls)),
 ]
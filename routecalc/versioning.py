@@ -0,0 +1,121 @@
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from .models import NetworkVersion
+from .snapshot import load_snapshot
+
+_version_lock = threading.Lock()
+_known_version = None
+_checked_at = 0.0
+
+
+def network_version(refresh=False):
+    """Current network data version, read from the DB at most once per
+    ``ROUTING_VERSION_POLL_INTERVAL`` seconds unless ``refresh`` is set."""
+    global _known_version, _checked_at
+    now = time.monotonic()
+    if (refresh or _known_version is None or
+            now - _checked_at >= settings.ROUTING_VERSION_POLL_INTERVAL):
+        with _version_lock:
+            if (refresh or _known_version is None or
+                    now - _checked_at >=
+                    settings.ROUTING_VERSION_POLL_INTERVAL):
+                _known_version = NetworkVersion.current()
+                _checked_at = now
+    return _known_version
+
+
+def bump_network_version():
+    global _known_version
+    NetworkVersion.bump()
+    _known_version = None
+
+
+class DerivedStructure:
+    """Process-wide structure built from the network tables.
+
+    ``Cls()`` returns the current instance, building it on first use. When
+    the network version moves past the one an instance was built from, the
+    next call starts a rebuild on a background thread and keeps returning
+    the old instance; the new one replaces it with a single assignment once
+    it is complete, so readers never wait and never see a partial build.
+
+    Subclasses listing their arrays in ``snapshot_fields`` (and the settings
+    those arrays depend on in ``snapshot_settings``) can instead be loaded
+    from a snapshot written by ``buildsnapshot``: the arrays are memory
+    mapped and ``_restore()`` derives the rest.
+    """
+    registry = []
+    snapshot_fields = ()
+    snapshot_settings = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._instance = None
+        cls._lock = threading.Lock()
+        cls._rebuilding = False
+        DerivedStructure.registry.append(cls)
+
+    def __new__(cls):
+        instance = cls._instance
+        if instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = cls._create()
+            return cls._instance
+        if instance.version != network_version():
+            cls.schedule_rebuild()
+        return instance
+
+    @classmethod
+    def _create(cls, use_snapshot=True):
+        instance = object.__new__(cls)
+        instance.version = network_version()
+        arrays = None
+        if use_snapshot and cls.snapshot_fields:
+            arrays = load_snapshot(cls, instance.version)
+        if arrays is None:
+            instance.source = 'database'
+            instance._build()
+        else:
+            instance.source = 'snapshot'
+            instance.__dict__.update(arrays)
+            instance._restore()
+        instance.built_at = time.time()
+        return instance
+
+    def _build(self):
+        raise NotImplementedError
+
+    def _restore(self):
+        pass
+
+    @classmethod
+    def schedule_rebuild(cls):
+        with cls._lock:
+            if cls._rebuilding:
+                return
+            cls._rebuilding = True
+        threading.Thread(target=cls._rebuild, daemon=True,
+                         name=f"rebuild-{cls.__name__}").start()
+
+    @classmethod
+    def _rebuild(cls):
+        try:
+            cls._instance = cls._create()
+        finally:
+            cls._rebuilding = False
+            connection.close()
+
+    @classmethod
+    def status(cls):
+        instance = cls._instance
+        return {
+            "version": instance.version if instance else None,
+            "built_at": instance.built_at if instance else None,
+            "source": instance.source if instance else None,
+            "stale": instance is None or
+            instance.version != network_version(),
+            "rebuilding": cls._rebuilding,
+        }
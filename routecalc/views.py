@@ -1,276 +1,165 @@
-import heapq
 from django.shortcuts import get_object_or_404
 from rest_framework.response import Response
-from .models import Line, Point, Step, Route
+from .models import Line, Point, Step, Route, project_coordinates
 from rest_framework import viewsets
 from rest_framework.views import APIView
 from .serializers import LineSerializer, PointSerializer
 from .serializers import StepSerializer, RouteSerializer
+from .serializers import BatchRoutesSerializer, DistanceMatrixSerializer
+from .serializers import RouteUploadSerializer
+import itertools
+import math
 import numpy
-from scipy.spatial import KDTree
-from django.db.models import QuerySet
-from .spatial_index import PointSpatialIndex
-
-
-def ClosestPoint(points: QuerySet[Point], point: Point) -> Point:
-    nparray = numpy.array(points)
-    tree = KDTree(nparray)
-    _, index = tree.query(point.__array__())
-    return points[int(index)]
-
-
-def ClosestPoints(points_qs, target_point, radius=50.0) -> list:
-    points_list = list(points_qs)
-    if not points_list:
-        return []
-    coords = numpy.array([p.__array__() for p in points_list])
-    tree = KDTree(coords)
-    target_coords = target_point.__array__()
-    indices = tree.query_ball_point(target_coords, radius)
-    nearby_points = [points_list[i] for i in indices]
-    return nearby_points
-
-
-def DistanceBetween(point_a: Point, point_b: Point) -> float:
-    return numpy.linalg.norm(point_a.__array__() - point_b.__array__())
-
-
-def reconstruct_path(end_step_id, predecessors, step_map):
-    path = []
-    current_id = end_step_id
-    while current_id is not None:
-        step = step_map[current_id]
-        path.append(step)
-        current_id = predecessors.get(current_id)
-    path.reverse()
-    return path
-
-
-def find_best_path(start_steps, end_point_ids, steps_by_point, step_map,
-                   switch_cost, penalized_edges, start_costs, end_costs):
-    pq = []
-    distances = {step_id: (float('inf'), float('inf'))
-                 for step_id in step_map.keys()}
-    predecessors = {}
-    entry_count = 0
-    best_result = (None, float('inf'), None, None)
-    for step in start_steps:
-        walk_cost = start_costs.get(step.point.id, 0.0)
-        cost = (walk_cost, 0)
-        distances[step.id] = cost
-        heapq.heappush(pq, (walk_cost, 0, entry_count, step.id))
-        entry_count += 1
-    EDGE_PENALTY = 100000.0
-    while pq:
-        current_dist, current_switches, _, current_step_id = heapq.heappop(pq)
-        if current_dist > best_result[1]:
-            continue
-        current_step = step_map[current_step_id]
-        if (current_dist > distances[current_step_id][0] and
-                current_switches > distances[current_step_id][1]):
-            continue
-        if current_step.point.id in end_point_ids:
-            final_walk = end_costs.get(current_step.point.id, 0.0)
-            total_dist = current_dist + final_walk
-            if total_dist < best_result[1]:
-                path = reconstruct_path(current_step_id, predecessors,
-                                        step_map)
-                best_result = (path, total_dist, path[0].point.id,
-                               current_step.point.id)
-        if current_step.next:
-            neighbor = current_step.next
-            weight = current_step.distance_to_next_step()
-            edge_key = (current_step_id, neighbor.id)
-            if edge_key in penalized_edges:
-                weight += EDGE_PENALTY
-            new_dist = current_dist + weight
-            new_switches = current_switches
-            new_cost = (new_dist, new_switches)
-            if new_cost < distances[neighbor.id]:
-                distances[neighbor.id] = new_cost
-                predecessors[neighbor.id] = current_step_id
-                heapq.heappush(pq, (new_dist, new_switches,
-                               entry_count, neighbor.id))
-                entry_count += 1
-        for switch_neighbor in steps_by_point.get(current_step.point.id, []):
-            if switch_neighbor.id == current_step_id:
-                continue
-            new_dist = current_dist + switch_cost
-            new_switches = current_switches + 1
-            new_cost = (new_dist, new_switches)
-            if new_cost < distances[switch_neighbor.id]:
-                distances[switch_neighbor.id] = new_cost
-                predecessors[switch_neighbor.id] = current_step_id
-                heapq.heappush(pq, (new_dist, new_switches,
-                               entry_count, switch_neighbor.id))
-                entry_count += 1
-    return best_result
-
-
-def calculatePaths(
-    start_point_ids: list[int],
-    end_point_ids: list[int],
-    start_costs: dict,
-    end_costs: dict,
-    K: int = 3,
-    switch_cost: float = 0.001,
-    walking_multiplier: float = 5.0
-) -> list[tuple[list, float]]:
-    all_steps = list(Step.objects.select_related(
-        'point', 'next__point', 'route').all())
-    step_map = {step.id: step for step in all_steps}
-    steps_by_point = {}
-    for step in all_steps:
-        point_id = step.point.id
-        if point_id not in steps_by_point:
-            steps_by_point[point_id] = []
-        steps_by_point[point_id].append(step)
-    start_steps = []
-    for point_id in start_point_ids:
-        start_steps.extend(steps_by_point.get(point_id, []))
-    if not start_steps:
-        return []
-    end_point_set = set(end_point_ids)
-    k_results = []
-    penalized_edges = set()
-    current_start_costs = {
-        k: v * walking_multiplier for k, v in start_costs.items()}
-    current_end_costs = {
-        k: v * walking_multiplier for k, v in end_costs.items()}
-    POINT_REUSE_PENALTY = 100000.0
-    for _ in range(K * 2):
-        path, search_score, s_id, e_id = find_best_path(
-            start_steps,
-            end_point_set,
-            steps_by_point,
-            step_map,
-            switch_cost,
-            penalized_edges,
-            current_start_costs,
-            current_end_costs
-        )
-        if not path:
-            break
-        path_ids = tuple(s.id for s in path)
-        if any(tuple(s.id for s in res[0]) == path_ids for res in k_results):
-            pass
-        else:
-            real_distance = start_costs.get(s_id, 0.0)
-            for i in range(len(path) - 1):
-                real_distance += path[i].distance_to_next_step()
-            real_distance += end_costs.get(e_id, 0.0)
-            k_results.append((path, real_distance))
-            if s_id in current_start_costs:
-                current_start_costs[s_id] += POINT_REUSE_PENALTY
-            if e_id in current_end_costs:
-                current_end_costs[e_id] += POINT_REUSE_PENALTY
-        for i in range(len(path) - 1):
-            source_step = path[i]
-            dest_step = path[i+1]
-            if source_step.route.id == dest_step.route.id:
-                penalized_edges.add((source_step.id, dest_step.id))
-        if len(k_results) >= K:
-            break
-    return k_results
-
-
-def convertBestPathsToResponse(bestPaths, o_x, o_y, d_x, d_y):
-    result = []
-    for tup in bestPaths:
-        currentRoute = None
-        l, dis = tup
-        l: list[Step] = l
-        segments = []
-        currentSegment = {}
-        currentSteps = []
-        walkingrouteOr = Route(
-            id=999,
-            line=Line(id=998, name="L000", color="#000000"),
-            isReturn=False,
-            distance=0,
-            time=0
-        )
-        walkingrouteDes = Route(
-            id=1001,
-            line=Line(id=1000, name="L000", color="#000000"),
-            isReturn=False,
-            distance=0,
-            time=0
-        )
-        originToPoint = {"route": RouteSerializer(walkingrouteOr).data,
-                         "path": [PointSerializer(Point(x_coord=o_x,
-                                                        y_coord=o_y)).data,
-                                  PointSerializer(l[0].point).data]}
-        for step in l:
-            if currentRoute is None:
-                currentRoute = step.route
-                currentSegment["route"] = RouteSerializer(step.route).data
-            if currentRoute != step.route:
-                currentSegment["path"] = currentSteps
-                segments.append(currentSegment)
-                currentSegment = {"route": RouteSerializer(step.route).data}
-                currentSteps = []
-                currentRoute = step.route
-            currentSteps.append(PointSerializer(step.point).data)
-        currentSegment["path"] = currentSteps
-        segments.append(currentSegment)
-        currentSegment = {"route": RouteSerializer(step.route).data}
-        currentSteps.append(PointSerializer(step.point).data)
-        destinationToPoint = {"route": RouteSerializer(walkingrouteDes).data,
-                              "path": [PointSerializer(l[-1].point).data,
-                                       PointSerializer(
-                                           Point(x_coord=d_x,
-                                                 y_coord=d_y)).data]}
-        result.append({
-            "distance": dis,
-            "segments": [originToPoint] + segments + [destinationToPoint]}
-        )
-    return result
+from .spatial_index import PointSpatialIndex, RouteSpatialIndex
+from .geometry import RouteGeometry, coverage_polygon
+from .encoding import GEOMETRY_FORMATS, DEFAULT_PRECISION, MAX_PRECISION
+from .encoding import encode_coordinates
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_header_parameters
+from .routing import SEARCH_MODES
+from .routing import search_executor, search_paths
+from .routing import reachable_points
+from .graph import TransitGraph
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from . import metrics
+from .metrics import ServerTimingMixin
+from concurrent.futures import Future
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
+from .renderers import NpyRenderer, PrerenderedJSONRenderer, RenderedJSON
+from .pagination import NetworkCursorPagination
+from .rendering import RiddenPath, RouteMetadata, render_paths
+from .matrix import distance_matrix, matrix_json
+from .tiles import TileIndex, render_tile, tile_cache
+from .importing import import_route
+from rest_framework.exceptions import ValidationError
+from .versioning import DerivedStructure, network_version
+from .cache import VersionedLRUCache
+from .concurrency import OffloadedAPIView, busy_response, search_limiter
+from .conditional import NetworkConditionalMixin, response_cache
+from django.conf import settings
+
+
+best_paths_cache = VersionedLRUCache('ROUTING_PATH_CACHE_SIZE',
+                                     'ROUTING_PATH_CACHE_TTL')
+
+
+def BestPathsKey(start_costs, end_costs, *parameters):
+    step = settings.ROUTING_PATH_CACHE_COST_STEP
+
+    def rounded(costs):
+        return tuple(sorted((point_id, round(cost / step))
+                            for point_id, cost in costs.items()))
+
+    return (rounded(start_costs), rounded(end_costs)) + parameters
 
 
 def RenderRoute(route: Route):
-    steps = []
-    currentStep: Step = route.first
-    while currentStep.next is not None:
-        steps.append(currentStep.point)
-        currentStep = currentStep.next
-    steps.append(currentStep.point)
-    return steps
-
-
-def IsWithinRange(route: Route, point: Point, radius: float):
-    steps = route.step_set.all()
-    points = [step.point for step in steps]
-    return DistanceBetween(point, ClosestPoint(points, point)) <= radius
-
-
-class LineViewSet(viewsets.ModelViewSet):
+    return [Point(x_coord=x, y_coord=y)
+            for x, y in RouteGeometry().coordinates(route.id).tolist()]
+
+
+def ParseNumber(value, name):
+    """``value`` from the URL as a finite float, with a comma allowed as
+    the decimal separator; anything else is a 400 on ``name``."""
+    try:
+        number = float(value.replace(',', '.'))
+    except ValueError:
+        number = math.nan
+    if not math.isfinite(number):
+        raise ValidationError({name: "Expected a finite number."})
+    return number
+
+
+def GeometryOptions(request):
+    """Geometry format and precision asked for through ``?geometry=`` and
+    ``?precision=``, or the same parameters on the Accept header, e.g.
+    ``Accept: application/json; geometry=polyline; precision=6``."""
+    _, accepted = parse_header_parameters(request.accepted_media_type or '')
+    geometry_format = request.query_params.get(
+        'geometry', accepted.get('geometry', 'points'))
+    if geometry_format not in GEOMETRY_FORMATS:
+        raise ValidationError(
+            {"geometry": f"Expected one of {', '.join(GEOMETRY_FORMATS)}."})
+    try:
+        precision = int(request.query_params.get(
+            'precision', accepted.get('precision', DEFAULT_PRECISION)))
+    except ValueError:
+        raise ValidationError({"precision": "Expected an integer."})
+    if not 0 <= precision <= MAX_PRECISION:
+        raise ValidationError(
+            {"precision": f"Must be between 0 and {MAX_PRECISION}."})
+    return geometry_format, precision
+
+
+def RenderRoutePath(route: Route, geometry_format, precision):
+    if geometry_format == 'points':
+        return PointSerializer(RenderRoute(route), many=True).data
+    return RouteGeometry().encoded(route.id, geometry_format, precision)
+
+
+def GeometryResponse(data):
+    response = Response(data)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+class NestedRelationsMixin:
+    """Loads the relations the serializer nests along with each page of
+    objects, instead of one query per object; deletes skip them."""
+    select_related = ()
+    prefetch_related = ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'destroy':
+            return queryset
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        return queryset
+
+
+class LineViewSet(NetworkConditionalMixin, NestedRelationsMixin,
+                  viewsets.ModelViewSet):
     queryset = Line.objects.all()
     serializer_class = LineSerializer
+    pagination_class = NetworkCursorPagination
+    # Prefetched routes get their line set from the parent.
+    prefetch_related = ('routes',)
 
 
-class PointViewSet(viewsets.ModelViewSet):
+class PointViewSet(NetworkConditionalMixin, viewsets.ModelViewSet):
     queryset = Point.objects.all()
     serializer_class = PointSerializer
+    pagination_class = NetworkCursorPagination
 
 
-class StepViewSet(viewsets.ModelViewSet):
+class StepViewSet(NetworkConditionalMixin, NestedRelationsMixin,
+                  viewsets.ModelViewSet):
     queryset = Step.objects.all()
     serializer_class = StepSerializer
+    pagination_class = NetworkCursorPagination
+    select_related = ('point', 'route__line')
 
 
-class RouteViewSet(viewsets.ModelViewSet):
+class RouteViewSet(NetworkConditionalMixin, NestedRelationsMixin,
+                   viewsets.ModelViewSet):
     queryset = Route.objects.all()
     serializer_class = RouteSerializer
+    pagination_class = NetworkCursorPagination
+    select_related = ('line',)
 
 
-class LineRoutesView(APIView):
+class LineRoutesView(NetworkConditionalMixin, OffloadedAPIView):
+    derived_structures = (RouteGeometry,)
+
     def get(self, request, line_id, *args, **kwargs):
         line = get_object_or_404(Line, id=line_id)
+        geometry_format, precision = GeometryOptions(request)
         renderedRoutes = []
-        routes = Route.objects.filter(line=line).all()
+        routes = Route.objects.filter(line=line).select_related('line')
         for route in routes:
-            jsonroute = PointSerializer(RenderRoute(route), many=True)
             renderedRoutes.append({
                 "id": route.id,
                 "lineName": route.line.name,
@@ -278,59 +167,370 @@ class LineRoutesView(APIView):
                 "isReturn": route.isReturn,
                 "distance": route.distance,
                 "time": route.time,
-                "path": jsonroute.data
+                "path": RenderRoutePath(route, geometry_format, precision)
             })
-        return Response(renderedRoutes)
+        return GeometryResponse(renderedRoutes)
 
 
-class CloseRoutesView(APIView):
+class CloseRoutesView(OffloadedAPIView):
     def get(self, request, x_coord, y_coord, radius, *args, **kwargs):
-        x_coord = float(x_coord.replace(',', '.'))
-        y_coord = float(y_coord.replace(',', '.'))
-        radius = float(radius.replace(',', '.'))
+        x_coord = ParseNumber(x_coord, 'x_coord')
+        y_coord = ParseNumber(y_coord, 'y_coord')
+        radius = ParseNumber(radius, 'radius')
+        geometry_format, precision = GeometryOptions(request)
         renderedRoutes = []
-        routes = Route.objects.all()
+        route_ids = RouteSpatialIndex().routes_within(x_coord, y_coord,
+                                                      radius)
+        routes = Route.objects.filter(id__in=route_ids).select_related(
+            'line').order_by('id')
         for route in routes:
-            if not IsWithinRange(
-                route,
-                Point(x_coord=x_coord, y_coord=y_coord),
-                radius
-            ):
-                continue
-            jsonroute = PointSerializer(RenderRoute(route), many=True)
             renderedRoutes.append({
                 "id": route.id,
                 "lineName": route.line.name,
                 "isReturn": route.isReturn,
                 "distance": route.distance,
                 "time": route.time,
-                "path": jsonroute.data
+                "path": RenderRoutePath(route, geometry_format, precision)
             })
-        return Response(renderedRoutes)
+        return GeometryResponse(renderedRoutes)
 
 
-class BestRoutesView(APIView):
+class BestRoutesView(ServerTimingMixin, OffloadedAPIView):
+    renderer_classes = [PrerenderedJSONRenderer, BrowsableAPIRenderer]
+
     def get(self, request, o_x, o_y, d_x, d_y, *args, **kwargs):
-        o_x = float(o_x.replace(',', '.'))
-        o_y = float(o_y.replace(',', '.'))
-        d_x = float(d_x.replace(',', '.'))
-        d_y = float(d_y.replace(',', '.'))
-        origin = Point(x_coord=o_x, y_coord=o_y)
-        destination = Point(x_coord=d_x, y_coord=d_y)
-        points = PointSpatialIndex()
-        o_l = points.query_radius(origin, radius_meters=300.0)
-        d_l = points.query_radius(destination, radius_meters=300.0)
-        if not o_l:
-            o = points.query(origin)
-            o_l = [o]
-        if not d_l:
-            d = points.query(destination)
-            d_l = [d]
-        start_costs = {p.id: DistanceBetween(origin, p) for p in o_l}
-        end_costs = {p.id: DistanceBetween(destination, p) for p in d_l}
-        start_ids = [p.id for p in o_l]
-        end_ids = [p.id for p in d_l]
-        result = calculatePaths(start_ids, end_ids, start_costs, end_costs,
-                                5, 200.0, 5)
-        renderedResult = convertBestPathsToResponse(result, o_x, o_y, d_x, d_y)
-        return Response(renderedResult)
+        o_x = ParseNumber(o_x, 'o_x')
+        o_y = ParseNumber(o_y, 'o_y')
+        d_x = ParseNumber(d_x, 'd_x')
+        d_y = ParseNumber(d_y, 'd_y')
+        with metrics.stage('snap'):
+            (start_ids, start_dists), (end_ids, end_dists) = (
+                PointSpatialIndex().snap([o_x, d_x], [o_y, d_y],
+                                         radius_meters=300.0))
+        start_ids = start_ids.tolist()
+        end_ids = end_ids.tolist()
+        start_costs = dict(zip(start_ids, start_dists.tolist()))
+        end_costs = dict(zip(end_ids, end_dists.tolist()))
+        search_mode = request.query_params.get('search')
+        if search_mode is not None and search_mode not in SEARCH_MODES:
+            raise ValidationError(
+                {"search": f"Expected one of {', '.join(SEARCH_MODES)}."})
+        try:
+            alternatives = int(request.query_params.get('alternatives', 5))
+        except ValueError:
+            raise ValidationError({"alternatives": "Expected an integer."})
+        if alternatives < 1:
+            raise ValidationError({"alternatives": "Must be at least 1."})
+        if search_mode is not None and alternatives > 1:
+            raise ValidationError(
+                {"search": "Only applies with alternatives=1."})
+        geometry_format, precision = GeometryOptions(request)
+        switch_cost, walking_multiplier = 200.0, 5
+        # Every search mode finds the same paths, so it is not part of the
+        # key.
+        key = BestPathsKey(start_costs, end_costs, alternatives, switch_cost,
+                           walking_multiplier)
+        with metrics.stage('cache'):
+            ridden = best_paths_cache.get(key)
+        if ridden is None:
+            with metrics.stage('graph'):
+                graph = TransitGraph()
+            result = search_paths(graph, start_ids, end_ids, start_costs,
+                                  end_costs, alternatives, switch_cost,
+                                  walking_multiplier,
+                                  search_mode=search_mode)
+            ridden = [RiddenPath(graph, path, distance, start_costs,
+                                 end_costs)
+                      for path, distance in result]
+            best_paths_cache.put(key, ridden, graph.version)
+        with metrics.stage('render'):
+            body = render_paths(ridden, start_costs, end_costs,
+                                o_x, o_y, d_x, d_y, geometry_format,
+                                precision)
+        return GeometryResponse(RenderedJSON(body))
+
+
+class ReachableStopsView(OffloadedAPIView):
+    """Stops reachable from a coordinate within ``budget``, in the cost
+    units of BestRoutesView: metres ridden, plus walked metres times the
+    walking multiplier, plus a fixed cost per transfer. With
+    ``?polygon=true`` the response also has a coverage polygon around the
+    stops, each widened by the walk its leftover budget still allows."""
+
+    def get(self, request, x_coord, y_coord, budget, *args, **kwargs):
+        x_coord = ParseNumber(x_coord, 'x_coord')
+        y_coord = ParseNumber(y_coord, 'y_coord')
+        budget = ParseNumber(budget, 'budget')
+        if budget < 0:
+            raise ValidationError({"budget": "Must not be negative."})
+        geometry_format, precision = GeometryOptions(request)
+        switch_cost, walking_multiplier, walk_radius = 200.0, 5, 300.0
+        (point_ids, dists), = PointSpatialIndex().snap(
+            [x_coord], [y_coord], radius_meters=walk_radius)
+        graph = TransitGraph()
+        start_costs = {}
+        for point_id, dist in zip(point_ids.tolist(), dists.tolist()):
+            index = graph.point_index(point_id)
+            if index is not None:
+                start_costs[index] = dist * walking_multiplier
+        reached = reachable_points(graph, start_costs, budget, switch_cost,
+                                   walking_multiplier)
+        indices = sorted(reached, key=lambda i: (reached[i], i))
+        ids = graph.point_ids[indices].tolist()
+        points = Point.objects.in_bulk(ids)
+        stops = [{"id": point_id,
+                  "x_coord": points[point_id].x_coord,
+                  "y_coord": points[point_id].y_coord,
+                  "cost": reached[index]}
+                 for index, point_id in zip(indices, ids)]
+        result = {"stops": stops}
+        if request.query_params.get('polygon') in ('1', 'true'):
+            origin = numpy.column_stack(
+                project_coordinates([x_coord], [y_coord]))
+            costs = numpy.array([budget] + [reached[i] for i in indices])
+            radii = numpy.minimum(
+                (budget - costs) / walking_multiplier, walk_radius)
+            radii[0] = min(budget / walking_multiplier, walk_radius)
+            ring = coverage_polygon(
+                numpy.vstack((origin, graph.point_coords[indices])), radii)
+            if geometry_format == 'points':
+                result["polygon"] = [{"x_coord": x, "y_coord": y}
+                                     for x, y in ring.tolist()]
+            else:
+                result["polygon"] = encode_coordinates(
+                    ring, geometry_format, precision)
+        return GeometryResponse(result)
+
+
+def ParsePair(pair):
+    if isinstance(pair, dict):
+        pair = [pair.get(key) for key in ('o_x', 'o_y', 'd_x', 'd_y')]
+    if not isinstance(pair, list) or len(pair) != 4:
+        raise ValueError("Expected [o_x, o_y, d_x, d_y].")
+    try:
+        pair = tuple(float(str(value).replace(',', '.')) for value in pair)
+    except ValueError:
+        raise ValueError("Coordinates must be numbers.")
+    if not all(math.isfinite(value) for value in pair):
+        raise ValueError("Coordinates must be finite.")
+    return pair
+
+
+class BatchRoutesView(APIView):
+    """Best routes for many origin/destination pairs, streamed back as one
+    JSON object per line in input order: ``{"index": i, "paths": [...]}``
+    or ``{"index": i, "error": "..."}``.
+
+    The request holds one ``search_limiter`` slot until its response is
+    closed, and keeps at most ``ROUTING_BATCH_MAX_IN_FLIGHT`` searches on
+    the worker pool."""
+
+    def post(self, request, *args, **kwargs):
+        serializer = BatchRoutesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        geometry_format, precision = GeometryOptions(request)
+        if not search_limiter.enter():
+            return busy_response()
+        try:
+            lines = self.lines(serializer.validated_data, geometry_format,
+                               precision)
+        except BaseException:
+            search_limiter.leave()
+            raise
+        return StreamingHttpResponse(search_limiter.holding(lines),
+                                     content_type='application/x-ndjson')
+
+    def lines(self, options, geometry_format, precision):
+        pairs = []
+        for pair in options['pairs']:
+            try:
+                pairs.append(ParsePair(pair))
+            except ValueError as error:
+                pairs.append(error)
+        coords = [pair for pair in pairs if not isinstance(pair, Exception)]
+        snapped = PointSpatialIndex().snap(
+            [c[0] for c in coords] + [c[2] for c in coords],
+            [c[1] for c in coords] + [c[3] for c in coords],
+            radius_meters=300.0)
+        snapped = iter(zip(snapped[:len(coords)], snapped[len(coords):]))
+
+        # Every distinct search runs once, on the worker pool, against the
+        # same graph snapshot; results are rendered on the request thread
+        # as the response is streamed.
+        graph = TransitGraph()
+        switch_cost, walking_multiplier = 200.0, 5
+        jobs = []
+        results = {}
+        searches = {}
+        for pair in pairs:
+            if isinstance(pair, Exception):
+                jobs.append(pair)
+                continue
+            (start_ids, start_dists), (end_ids, end_dists) = next(snapped)
+            start_costs = dict(zip(start_ids.tolist(), start_dists.tolist()))
+            end_costs = dict(zip(end_ids.tolist(), end_dists.tolist()))
+            key = BestPathsKey(start_costs, end_costs,
+                               options['alternatives'], switch_cost,
+                               walking_multiplier)
+            if key not in results:
+                results[key] = best_paths_cache.get(key)
+                if results[key] is None:
+                    searches[key] = (start_costs, end_costs)
+            jobs.append((pair, key, start_costs, end_costs))
+
+        def generate():
+            renderer = JSONRenderer()
+            # Searches are started in the order of their first line, so the
+            # one the next line waits for is always among those running.
+            queued = iter(searches.items())
+            running = 0
+            try:
+                for index, job in enumerate(jobs):
+                    for key, (start_costs, end_costs) in itertools.islice(
+                            queued, settings.ROUTING_BATCH_MAX_IN_FLIGHT -
+                            running):
+                        results[key] = search_executor().submit(
+                            search_paths, graph, list(start_costs),
+                            list(end_costs), start_costs, end_costs,
+                            options['alternatives'], switch_cost,
+                            walking_multiplier,
+                            search_mode=options.get('search'))
+                        running += 1
+                    try:
+                        if isinstance(job, Exception):
+                            raise job
+                        (o_x, o_y, d_x, d_y), key, start_costs, end_costs = (
+                            job)
+                        if isinstance(results[key], Future):
+                            future = results[key]
+                            running -= 1
+                            try:
+                                results[key] = [
+                                    RiddenPath(graph, path, distance,
+                                               start_costs, end_costs)
+                                    for path, distance in future.result()]
+                            except Exception as error:
+                                # Repeated for every line of this search.
+                                results[key] = error
+                                raise
+                            best_paths_cache.put(key, results[key],
+                                                 graph.version)
+                        elif isinstance(results[key], Exception):
+                            raise results[key]
+                        line = b'{"index":%d,"paths":%s}' % (
+                            index, render_paths(
+                                results[key], start_costs, end_costs,
+                                o_x, o_y, d_x, d_y, geometry_format,
+                                precision))
+                    except Exception as error:
+                        line = renderer.render(
+                            {"index": index, "error": str(error)})
+                    yield line + b"\n"
+            finally:
+                # Searches of a response closed early are dropped unless
+                # they already started.
+                for result in results.values():
+                    if isinstance(result, Future):
+                        result.cancel()
+
+        return generate()
+
+
+class RouteUploadView(APIView):
+    """Create a route, its steps and any missing points from an ordered
+    list of stop coordinates in one request."""
+
+    def post(self, request, *args, **kwargs):
+        serializer = RouteUploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        options = serializer.validated_data
+        route, created = import_route(
+            options['line'], options['isReturn'], options['time'],
+            options['coordinates'],
+            options.get('snap_tolerance',
+                        settings.ROUTING_UPLOAD_SNAP_TOLERANCE))
+        stops = len(options['coordinates'])
+        return Response({"route": RouteSerializer(route).data,
+                         "steps": stops,
+                         "points_created": created,
+                         "points_reused": stops - created},
+                        status=201)
+
+
+class DistanceMatrixView(OffloadedAPIView):
+    """Network distances in metres between stops, riding and walking, with
+    transfers free. JSON by default (``null`` when unreachable) or a
+    float32 ``.npy`` array with ``?format=npy`` or
+    ``Accept: application/x-npy``."""
+    renderer_classes = [JSONRenderer, BrowsableAPIRenderer, NpyRenderer]
+
+    def post(self, request, *args, **kwargs):
+        serializer = DistanceMatrixSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        origins = serializer.validated_data['origins']
+        destinations = serializer.validated_data['destinations']
+        try:
+            matrix = distance_matrix(TransitGraph(), origins, destinations)
+        except KeyError as error:
+            raise ValidationError({"points": f"Unknown points {error}."})
+        if request.accepted_renderer.format == 'npy':
+            return Response(matrix.astype(numpy.float32))
+        return Response(matrix_json(origins, destinations, matrix))
+
+    def handle_exception(self, exc):
+        # Errors are always reported as JSON.
+        renderer = getattr(self.request, 'accepted_renderer', None)
+        if renderer is not None and renderer.format == 'npy':
+            self.request.accepted_renderer = JSONRenderer()
+            self.request.accepted_media_type = JSONRenderer.media_type
+        return super().handle_exception(exc)
+
+
+class TileView(NetworkConditionalMixin, APIView):
+    """Stops and route lines clipped to one XYZ (Web Mercator) tile, with
+    coordinates rounded to what the zoom can show. Stops are left out
+    below ``ROUTING_TILE_STOPS_MIN_ZOOM``."""
+    renderer_classes = [PrerenderedJSONRenderer, BrowsableAPIRenderer]
+    conditional_cache = tile_cache
+    derived_structures = (TileIndex, RouteMetadata)
+
+    def get(self, request, z, x, y, *args, **kwargs):
+        if not (settings.ROUTING_TILE_MIN_ZOOM <= z <=
+                settings.ROUTING_TILE_MAX_ZOOM and
+                0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise Http404("No such tile.")
+        geometry_format, _ = GeometryOptions(request)
+        return GeometryResponse(RenderedJSON(render_tile(
+            z, x, y, geometry_format,
+            settings.ROUTING_TILE_STOPS_MIN_ZOOM)))
+
+
+class NetworkStatusView(APIView):
+    def get(self, request, *args, **kwargs):
+        return Response({
+            "version": network_version(),
+            "structures": {cls.__name__: cls.status()
+                           for cls in DerivedStructure.registry},
+            "caches": {"best_routes": best_paths_cache.stats(),
+                       "responses": response_cache.stats(),
+                       "tiles": tile_cache.stats()},
+        })
+
+
+def MetricsView(request):
+    cache = best_paths_cache.stats()
+    responses = response_cache.stats()
+    return HttpResponse(
+        metrics.prometheus_text([
+            ("routecalc_path_cache_hits_total",
+             "Best-route cache hits.", cache["hits"]),
+            ("routecalc_path_cache_misses_total",
+             "Best-route cache misses.", cache["misses"]),
+            ("routecalc_path_cache_evictions_total",
+             "Best-route cache evictions.", cache["evictions"]),
+            ("routecalc_response_cache_hits_total",
+             "Network response cache hits.", responses["hits"]),
+            ("routecalc_response_cache_misses_total",
+             "Network response cache misses.", responses["misses"]),
+        ]),
+        content_type='text/plain; version=0.0.4; charset=utf-8')